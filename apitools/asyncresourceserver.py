@@ -0,0 +1,479 @@
+import json
+import re
+import sys
+import traceback
+from urllib.parse import parse_qsl
+
+import sqlalchemy
+from sqlalchemy import Boolean, Column, Float, Integer, String, exc, insert, select
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import declarative_base, declared_attr, sessionmaker
+from sqlalchemy.orm import exc as orm_exc
+
+from .flasksqlalchemymodelgenerator import FlaskSQLAlchemyModelGenerator
+from .modelgenerator import UnknownPropertyError, MissingRequiredPropertyError, ReadOnlyPropertyError
+from .validation import ValidationError
+from .serializers import get_serializer
+from . import utils
+
+# SQLAlchemy 2 inserts many rows per statement and still returns their generated keys
+batched_returning = int(sqlalchemy.__version__.split(".")[0]) >= 2
+
+
+class TableName:
+    @declared_attr
+    def __tablename__(cls):
+        # same table names as flask-sqlalchemy, so both servers can use the same database
+        return re.sub(r"([a-z0-9])([A-Z])", r"\1_\2", cls.__name__).lower()
+
+
+class Database:
+    """The parts of flask-sqlalchemy's db used by the model generator"""
+    Column = Column
+    Integer = Integer
+    Float = Float
+    Boolean = Boolean
+    String = String
+
+    def __init__(self):
+        self.Model = declarative_base(cls=TableName)
+
+
+class Request:
+    """The parts of an ASGI http request used by the routes"""
+
+    def __init__(self, scope, body):
+        self.method = scope["method"]
+        self.path = scope["path"]
+        self.data = body
+        self.headers = dict((name.decode("latin-1").lower(), value.decode("latin-1"))
+                            for name, value in scope.get("headers", []))
+        self.mimetype = self.headers.get("content-type", "").split(";")[0].strip().lower()
+
+        # first value of each argument, like flask's request.args.get
+        self.args = {}
+        for name, value in parse_qsl(scope.get("query_string", b"").decode("latin-1")):
+            self.args.setdefault(name, value)
+
+        self.form = {}
+        if self.mimetype == "application/x-www-form-urlencoded":
+            self.form = dict(parse_qsl(body.decode("utf-8")))
+
+    def if_none_match(self, etag):
+        header = self.headers.get("if-none-match", "")
+        tags = [tag.strip() for tag in header.split(",") if tag.strip()]
+        return "*" in tags or ('"%s"' % etag) in tags
+
+
+def input_error(error, code=400):
+    return (json.dumps({"error":str(error)}), code, {"Content-Type":"application/json"})
+
+def not_found():
+    return input_error("Not Found", 404)
+
+def conditional_response(request, body, etag):
+    """Returns the json body, or 304 if the client already has this version"""
+    headers = {"ETag":'"%s"' % etag}
+    if request.if_none_match(etag):
+        return ("", 304, headers)
+    headers["Content-Type"] = "application/json"
+    return (body, 200, headers)
+
+
+class AsyncResourceServer:
+    """ASGI version of ResourceServer, for many concurrent clients.
+    Routes are async and use an async SQLAlchemy engine, with a pool of
+    pool_size connections (+ max_overflow when busy). Requests, responses
+    and errors are the same as ResourceServer's."""
+
+    def __init__(self, host="0.0.0.0", port=5000, database_uri="sqlite+aiosqlite:////tmp/test.db",
+                 pool_size=10, max_overflow=20, bulk_batch_size=1000, stream_chunk_size=1000,
+                 cache_size=1024, serializer=None, schemas_store=None, **engine_options):
+        if not database_uri.startswith("sqlite") or ":memory:" not in database_uri:
+            # in memory sqlite uses a single connection
+            engine_options.setdefault("pool_size", pool_size)
+            engine_options.setdefault("max_overflow", max_overflow)
+        self.engine = create_async_engine(database_uri, **engine_options)
+        self.session = sessionmaker(self.engine, class_=AsyncSession, expire_on_commit=False)
+        self.db = Database()
+
+        # the resources added by name follow the validators of the store
+        self.model_generator = FlaskSQLAlchemyModelGenerator(schemas_store)
+
+        # (regex, methods, handler), in the order they were added
+        self.routes = []
+
+        # store these here to be able to generate links
+        self.host = host
+        self.port = port
+
+        self.bulk_batch_size = bulk_batch_size
+        self.stream_chunk_size = stream_chunk_size
+        self.response_cache = utils.ResponseCache(cache_size)
+
+        # serializer instance or name, see serializers.get_serializer
+        if serializer is None or isinstance(serializer, str):
+            serializer = get_serializer(serializer)
+        self.serializer = serializer
+
+    def run(self, **kwargs):
+        """Shortcut to start the server with uvicorn"""
+        import uvicorn
+        kwargs["host"] = self.host
+        kwargs["port"] = self.port
+        uvicorn.run(self, **kwargs)
+
+    async def create_all(self):
+        """Creates the tables of the resources added"""
+        async with self.engine.begin() as connection:
+            await connection.run_sync(self.db.Model.metadata.create_all)
+
+    async def add_all(self, session, model, resources):
+        """Inserts many instances of model in the session's transaction,
+        bulk_batch_size rows per statement. The keys generated by the
+        database are set on the instances."""
+        implicit_key = model.implicit_key
+        key_column = getattr(model, model.key_name)
+        for start in range(0, len(resources), self.bulk_batch_size):
+            batch = resources[start:start+self.bulk_batch_size]
+            mappings = [resource.properties_values() for resource in batch]
+            if implicit_key and batched_returning:
+                # implicit keys are autoincremented in the order of the rows, sorting them is
+                # enough to match them, sort_by_parameter_order would be one statement per row in sqlite
+                result = await session.execute(insert(model).returning(key_column), mappings)
+                for resource, key in zip(batch, sorted(result.scalars().all())):
+                    setattr(resource, model.key_name, key)
+            else:
+                # before SQLAlchemy 2 fetching the generated keys needs one statement per row
+                await session.run_sync(lambda sync_session: sync_session.bulk_insert_mappings(
+                    model, mappings, return_defaults=implicit_key))
+                if implicit_key:
+                    for resource, mapping in zip(batch, mappings):
+                        setattr(resource, model.key_name, mapping[model.key_name])
+        await session.commit()
+
+    def host_str(self):
+        return "http://%s:%d"%(self.host, self.port)
+
+    def cache_invalidate(self, resource):
+        self.response_cache.invalidate(resource.__class__.__name__,
+                                       getattr(resource, resource.key_name))
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            while True:
+                message = await receive()
+                if message["type"] == "lifespan.startup":
+                    await send({"type":"lifespan.startup.complete"})
+                elif message["type"] == "lifespan.shutdown":
+                    await self.engine.dispose()
+                    await send({"type":"lifespan.shutdown.complete"})
+                    return
+        if scope["type"] != "http":
+            return
+
+        body = b""
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get("body", b"")
+            more_body = message.get("more_body", False)
+
+        request = Request(scope, body)
+        # HEAD is answered like GET without the body, as flask does
+        head = request.method == "HEAD"
+        if head:
+            request.method = "GET"
+        try:
+            response = await self.dispatch(request)
+        except Exception:
+            traceback.print_exc()
+            response = input_error("Internal Server Error", 500)
+        await self.send_response(send, *response, head=head)
+
+    async def dispatch(self, request):
+        allowed = False
+        for regex, methods, handler in self.routes:
+            match = regex.match(request.path)
+            if not match:
+                continue
+            # several links can have the same href with different methods
+            if request.method not in methods:
+                allowed = True
+                continue
+            return await handler(request, **handler.convert(match.groupdict()))
+        return input_error("Method Not Allowed", 405) if allowed else not_found()
+
+    async def send_response(self, send, body, status, headers, head=False):
+        # ASGI header names are lowercase
+        headers = [(name.lower().encode("latin-1"), str(value).encode("latin-1"))
+                   for name, value in list(headers.items())]
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+            headers.append((b"content-length", str(len(body)).encode("latin-1")))
+            await send({"type":"http.response.start", "status":status, "headers":headers})
+            await send({"type":"http.response.body", "body":b"" if head else body})
+            return
+
+        # streamed body
+        await send({"type":"http.response.start", "status":status, "headers":headers})
+        if head:
+            await body.aclose()
+            await send({"type":"http.response.body", "body":b""})
+            return
+        async for chunk in body:
+            await send({"type":"http.response.body", "body":chunk.encode("utf-8"), "more_body":True})
+        await send({"type":"http.response.body", "body":b""})
+
+    def add_resource(self, schema):
+        """Add the resource to the list of resources the server can handle,
+        schema can be the name of a schema of the server's schemas_store"""
+
+        # generate and store the model
+        model = self.model_generator.generate(self.db, schema)
+        setattr(self, model.__name__, model)
+
+        def add_route(fn, methods=["GET"]):
+            # transform the link href into a regex and converters
+            href = model.links[fn.__name__.replace("r_","")]
+            converters = dict((arg_name, utils.property_types[model.properties[arg_name]["type"]])
+                              for arg_name in utils.get_url_args(href))
+            fn.convert = lambda groups: dict((name, converters[name](value))
+                                             for name, value in list(groups.items()))
+            self.routes.append((utils.url_to_regex(href, model), methods, fn))
+
+        # read the columns in the schema order and encode them without building dicts
+        key_column = getattr(model, model.key_name)
+        columns = list(model.properties.keys())
+        columns_encoder = lambda names: self.serializer.row_encoder(
+            names, [model.properties[name]["type"] for name in names])
+        encode = columns_encoder(columns)
+
+        async def stream_instances(query, encode, ndjson):
+            # fetch and send the rows stream_chunk_size at a time
+            separator = "\n" if ndjson else ","
+            started = False
+            if not ndjson:
+                yield "["
+            async with self.session() as session:
+                result = await session.stream(query)
+                async for rows in result.partitions(self.stream_chunk_size):
+                    yield (separator if started else "") + separator.join(
+                        [encode(row) for row in rows])
+                    started = True
+            yield "\n" if ndjson else "]"
+
+        # generate routes automatically for some of the links
+        if "instances" in model.links:
+            key_type = utils.property_types.get(model.properties[model.key_name]["type"], str)
+
+            # returns the instances of the model, same arguments as ResourceServer
+            async def r_instances(request, **kwargs):
+                try:
+                    limit = request.args.get("limit", None)
+                    limit = int(limit) if limit is not None else None
+                    offset = int(request.args.get("offset", 0))
+                    after = request.args.get("after", None)
+                    after = key_type(after) if after is not None else None
+                except ValueError as error:
+                    return input_error("Invalid pagination: %s"%error)
+
+                try:
+                    clauses = utils.filter_clauses(model, request.args)
+                except ValueError as error:
+                    return input_error("Invalid filter: %s"%error)
+
+                fields = request.args.get("fields", None)
+                if fields:
+                    fields = fields.split(",")
+                    for field in fields:
+                        if field not in model.properties:
+                            return input_error(UnknownPropertyError(model.__name__, field))
+                    row_encoder = columns_encoder(fields)
+                else:
+                    fields = columns
+                    row_encoder = encode
+                # only select the columns needed, with the key for the next link
+                query = select(*[getattr(model, field) for field in fields + [model.key_name]])
+
+                if clauses:
+                    query = query.where(*clauses)
+                if after is not None:
+                    query = query.where(key_column > after)
+                if limit is not None or offset or after is not None:
+                    query = query.order_by(key_column)
+                if offset:
+                    query = query.offset(offset)
+                if limit is not None:
+                    query = query.limit(limit)
+
+                stream = request.args.get("stream", None)
+                if stream in ["json", "ndjson"]:
+                    return (stream_instances(query, row_encoder, stream == "ndjson"), 200,
+                            {"Content-Type":"application/x-ndjson" if stream == "ndjson" else "application/json"})
+
+                async with self.session() as session:
+                    result = await session.execute(query)
+                    rows = result.all()
+
+                headers = {"Content-Type":"application/json"}
+                if limit and len(rows) == limit:
+                    headers["Link"] = '<%s%s?%s>; rel="next"' % (
+                        self.host_str(), model.links["instances"],
+                        utils.next_page_query(request.args, limit, rows[-1][-1]))
+                return ("[%s]" % ", ".join([row_encoder(row) for row in rows]), 200, headers)
+            add_route(r_instances)
+
+        if "self" in model.links:
+            # the schema doesn't change, serialize it once
+            schema_body = self.serializer.dumps(model.schema)
+            schema_etag = utils.make_etag(schema_body)
+
+            # returns an instance of the object by key, from the cache if possible
+            # if used with OPTIONS, returns the json-schema
+            async def r_self(request, **kwargs):
+                if len(list(kwargs.keys())) != 1:
+                    raise Exception("Self link with multiple arguments not supported")
+
+                if request.method == "OPTIONS":
+                    return conditional_response(request, schema_body, schema_etag)
+
+                key = list(kwargs.values())[0]
+                if request.method == "GET":
+                    entry = self.response_cache.get(model.__name__, key)
+                    if entry is None:
+                        generation = self.response_cache.generation()
+                        async with self.session() as session:
+                            row = (await session.execute(select(
+                                *[getattr(model, column) for column in columns]).where(key_column == key))).first()
+                        if not row:
+                            return not_found()
+                        entry = self.response_cache.put(model.__name__, key, encode(row), generation)
+                    return conditional_response(request, *entry)
+
+                async with self.session() as session:
+                    res = (await session.execute(select(model).filter_by(**kwargs))).scalars().first()
+                    if not res:
+                        return not_found()
+
+                    if request.method == "DELETE":
+                        await session.delete(res)
+                        await session.commit()
+                        self.cache_invalidate(res)
+                        return ("", 204, {})
+
+                    # PUT
+                    if len(request.form):
+                        attribs = request.form
+                    elif len(request.data):
+                        attribs = json.loads(request.data)
+                    else:
+                        return input_error("empty body")
+                    for key, value in list(attribs.items()):
+                        # don't let the update change readonly
+                        # properties like the primary key
+                        if key not in res.properties:
+                            return input_error(UnknownPropertyError(res.__class__.__name__, key))
+
+                        if not res.updatable(key):
+                            return input_error(ReadOnlyPropertyError(res.__class__.__name__, key))
+                        try:
+                            setattr(res, key, value)
+                        except ValidationError as error:
+                            return input_error(error)
+
+                    try:
+                        await session.commit()
+                    except orm_exc.StaleDataError:
+                        # deleted by another request since it was read
+                        return not_found()
+                    self.cache_invalidate(res)
+                    return ("", 200, {})
+            add_route(r_self, ["GET", "OPTIONS", "DELETE", "PUT"])
+
+        if "create" in model.links:
+            async def bulk_create(items):
+                # validate all the items first, the model checks the input in __init__
+                results = []
+                new_objs = []
+                for attribs in items:
+                    try:
+                        if not isinstance(attribs, dict):
+                            raise ValueError("not an object")
+                        new_objs.append(model(**attribs))
+                        results.append(None)
+                    except (ValueError, ValidationError, MissingRequiredPropertyError,
+                            UnknownPropertyError, ReadOnlyPropertyError) as error:
+                        results.append({"error":str(error)})
+
+                # insert the valid ones in one transaction
+                try:
+                    async with self.session() as session:
+                        await self.add_all(session, model, new_objs)
+                except exc.IntegrityError as error:
+                    return input_error(error, 409)
+
+                created = iter(new_objs)
+                results = [result or next(created).key_dict() for result in results]
+                return (self.serializer.dumps(results),
+                        201 if len(new_objs) == len(results) else 207,
+                        {"Content-Type":"application/json"})
+
+            # creates a new instance, or many if given a json array
+            # or newline-delimited json
+            async def r_create(request, **kwargs):
+                try:
+                    if request.mimetype in ["application/x-ndjson", "application/ndjson"]:
+                        return await bulk_create([json.loads(line) for line in
+                                                  request.data.decode("utf-8").splitlines()
+                                                  if line.strip()])
+
+                    if len(request.form):
+                        attribs = request.form
+                    elif len(request.data):
+                        attribs = json.loads(request.data)
+                    else:
+                        return input_error("empty body")
+
+                    if isinstance(attribs, list):
+                        return await bulk_create(attribs)
+
+                    # this is ok as the model checks the input in __init__
+                    new_obj = model(**attribs)
+
+                    # saves the object and return
+                    async with self.session() as session:
+                        session.add(new_obj)
+                        await session.commit()
+                    return (self.serializer.dumps(new_obj.key_dict()), 201,
+                            {"Content-Type":"application/json",
+                             "Location":"%s%s"%(self.host_str(), new_obj.self_link())})
+                except ValueError as error:
+                    # invalid json
+                    return input_error("Invalid data: %s"%error)
+                except ValidationError as error:
+                    return input_error(error)
+                except exc.IntegrityError as error:
+                    return input_error(error, 409)
+                except MissingRequiredPropertyError as error:
+                    return input_error(error)
+                except UnknownPropertyError as error:
+                    return input_error(error)
+                except ReadOnlyPropertyError as error:
+                    return input_error(error)
+
+            add_route(r_create, ["POST"])
+        return model
+
+if __name__ == "__main__":
+    import asyncio
+
+    server = AsyncResourceServer()
+
+    for path in sys.argv[1:]:
+        schema = json.loads(open(path).read())
+        server.add_resource(schema)
+        print("Added %s"%schema["name"])
+
+    asyncio.run(server.create_all())
+    server.run()
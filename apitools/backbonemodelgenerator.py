@@ -48,8 +48,8 @@ App.Collections.{{ model_name }}s = Backbone.Collection.extend({
 
 class BackboneModelGenerator(ModelGenerator):
 
-      def __init__(self):
-            ModelGenerator.__init__(self)
+      def __init__(self, schemas_store=None):
+            ModelGenerator.__init__(self, schemas_store)
 
       def generate(self, schemas, output_type="html"):
             if not output_type in ["js", "wrapped", "html" ]:
@@ -59,6 +59,7 @@ class BackboneModelGenerator(ModelGenerator):
                   return "\n".join((num_spaces * " ") + i for i in text.splitlines())
 
             def generate_one(schema):
+                  schema = self.get_schema(schema)
                   attribs = ModelGenerator.generate(self, schema)
 
                   template_args = {
@@ -70,7 +71,7 @@ class BackboneModelGenerator(ModelGenerator):
 
                   return backbone_template.render(template_args)
 
-            if isinstance(schemas, dict):
+            if isinstance(schemas, (dict, str)):
                   result = [generate_one(schemas)]
             else:
                   result = [generate_one(schema) for schema in schemas]
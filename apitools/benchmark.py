@@ -0,0 +1,371 @@
+import copy
+import json
+import optparse
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+import timeit
+
+from .datagenerator import DataGenerator
+from .invaliddatagenerator import InvalidDataGenerator
+from .modelgenerator import ModelGenerator
+from .schemasstore import SchemasStore
+from .validation import Validator, generate_validator_for_property
+from . import utils
+
+schemas_folder = os.path.join(os.path.dirname(__file__), "data/schemas")
+
+# schemas of the values generated by type
+type_schemas = {
+    "integer":{"type":"integer", "minimum":0, "maximum":1000},
+    "number":{"type":"number", "minimum":-10, "maximum":10},
+    "boolean":{"type":"boolean"},
+    "string":{"type":"string", "minLength":5, "maxLength":20},
+    "string pattern":{"type":"string", "pattern":"0[0-9]{10}"},
+    "string date-time":{"type":"string", "format":"date-time"},
+    "array":{"type":"array", "items":{"type":"integer"}, "minItems":5, "maxItems":10},
+    "array uniqueItems":{"type":"array", "items":{"type":"integer", "minimum":0, "maximum":20},
+                         "minItems":10, "maxItems":10, "uniqueItems":True},
+}
+
+# self-referencing schemas, the generated documents are checked before timing them
+recursive_schemas = [
+    {"name":"node", "type":"object", "properties":{
+        "value":{"type":"integer", "required":True},
+        "children":{"type":"array", "required":True, "items":{"type":"node"}}}},
+    {"name":"tree", "type":"object", "properties":{
+        "name":{"type":"string", "required":True},
+        "root":{"type":"node"}}},
+]
+
+# largest json document accepted from a recursive schema
+max_recursive_size = 64 * 1024
+
+# schemas and values checked by the property validators
+validator_cases = {
+    "integer":({"type":"integer", "minimum":0, "maximum":1000, "divisibleBy":2}, 42),
+    "number":({"type":"number", "minimum":-10, "maximum":10, "exclusiveMaximum":True}, 3.5),
+    "string":({"type":"string", "minLength":1, "maxLength":140}, "hello world"),
+    "string pattern":({"type":"string", "pattern":"0[0-9]{10}"}, "01234567890"),
+    "enum":({"type":"string", "enum":["red", "green", "blue"]}, "blue"),
+}
+
+
+def git_commit():
+    """Returns the commit of the working tree if it's a git repository"""
+    try:
+        output = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                         cwd=os.path.dirname(__file__), stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.decode("utf-8").strip()
+
+
+def write_schemas(folder, count):
+    """Writes count schemas to folder, each one using the previous one as a
+    named type, so resolving the last one expands all of them"""
+    for index in range(count):
+        properties = {
+            "id":{"type":"integer", "minimum":0},
+            "name":{"type":"string", "required":True, "maxLength":50},
+            "tags":{"type":"array", "items":{"type":"string"}, "uniqueItems":True},
+            "score":{"type":"number", "minimum":0, "maximum":1},
+        }
+        if index:
+            properties["parent"] = {"type":"synthetic_%d" % (index - 1)}
+        schema = {
+            "name":"synthetic_%d" % index,
+            "type":"object",
+            "properties":properties,
+            "links":[{"rel":"self", "href":"{id}"}],
+        }
+        with open(os.path.join(folder, "synthetic_%d.json" % index), "w") as out:
+            json.dump(schema, out)
+
+
+class Suite:
+    """Times functions with timeit and keeps the results by name.
+    The number of calls per measure is chosen like python -m timeit does,
+    so each measure takes at least min_time seconds, and the best, mean and
+    standard deviation of repeat measures are kept, as seconds per call."""
+
+    def __init__(self, repeat=5, min_time=0.2, selected=None, verbose=True):
+        self.repeat = repeat
+        self.min_time = min_time
+        self.selected = selected
+        self.verbose = verbose
+        self.results = {}
+
+    def is_selected(self, name):
+        return not self.selected or any(pattern in name for pattern in self.selected)
+
+    def add(self, name, fn):
+        if not self.is_selected(name):
+            return
+        timer = timeit.Timer(fn)
+        number = 1
+        while True:
+            if timer.timeit(number) >= self.min_time:
+                break
+            number *= 10
+        times = [duration / number for duration in timer.repeat(self.repeat, number)]
+        self.results[name] = {
+            "number":number,
+            "repeat":self.repeat,
+            "best":min(times),
+            "mean":statistics.mean(times),
+            "stdev":statistics.stdev(times) if len(times) > 1 else 0.0,
+        }
+        if self.verbose:
+            print(format_result(name, self.results[name]))
+
+    def skip(self, group, reason):
+        if self.verbose:
+            print("%s: skipped, %s" % (group, reason))
+
+    def report(self):
+        return {
+            "meta":{
+                "commit":git_commit(),
+                "date":time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "python":platform.python_version(),
+                "implementation":platform.python_implementation(),
+                "platform":platform.platform(),
+            },
+            "benchmarks":self.results,
+        }
+
+
+def bench_datagenerator(suite, store):
+    generator = DataGenerator(store, seed=0)
+    for name, schema in list(type_schemas.items()):
+        suite.add("datagenerator random_value %s" % name, lambda schema=schema: generator.random_value(schema))
+    for name in ["book", "search_results"]:
+        suite.add("datagenerator random_value %s" % name, lambda name=name: generator.random_value(name))
+        generate = generator.compile(name)
+        suite.add("datagenerator compiled %s" % name, generate)
+
+    recursive_store = SchemasStore()
+    for schema in recursive_schemas:
+        recursive_store.add_schema(copy.deepcopy(schema))
+    recursive_generator = DataGenerator(recursive_store, seed=0)
+    for name in ["node", "tree"]:
+        check_recursive(recursive_generator, Validator(name, recursive_store), name)
+        suite.add("datagenerator random_value %s (recursive)" % name,
+                  lambda name=name: recursive_generator.random_value(name))
+
+
+def check_recursive(generator, validator, name, count=100):
+    """Raises if the recursive type doesn't generate valid documents of bounded size"""
+    for instance in generator.generate_many(name, count):
+        if not validator.is_valid(instance):
+            raise Exception("Invalid %s generated: %s" % (name, validator.errors(instance)))
+        size = len(json.dumps(instance))
+        if size > max_recursive_size:
+            raise Exception("Generated %s of %d bytes, more than %d" % (name, size, max_recursive_size))
+
+
+def bench_invaliddatagenerator(suite, store):
+    generator = InvalidDataGenerator(store, seed=0)
+    for name in ["integer", "string pattern"]:
+        schema = type_schemas[name]
+        suite.add("invaliddatagenerator invalid_value %s" % name, lambda schema=schema: generator.invalid_value(schema))
+
+        def uncached(schema=schema):
+            generator.corpus_cache.clear()
+            return generator.invalid_value(schema)
+        suite.add("invaliddatagenerator invalid_value %s uncached" % name, uncached)
+
+    for name in ["book", "search_results"]:
+        suite.add("invaliddatagenerator 100 invalid documents %s" % name,
+                  lambda name=name: list(generator.iter_invalid_documents(name, 100)))
+
+
+def bench_validation(suite, store):
+    for name, (schema, value) in list(validator_cases.items()):
+        suite.add("validation generate_validator_for_property %s" % name,
+                  lambda name=name, schema=schema: generate_validator_for_property(name, schema))
+        validator = generate_validator_for_property(name, schema)
+        suite.add("validation validator %s" % name,
+                  lambda validator=validator, name=name, value=value: validator(None, name, value))
+
+    generator = DataGenerator(store, seed=0)
+    for name in ["book", "search_results"]:
+        validator = Validator(name, store)
+        instance = generator.random_value(name)
+        suite.add("validation Validator %s" % name, lambda validator=validator, instance=instance: validator.is_valid(instance))
+
+
+def bench_modelgenerator(suite, store):
+    generator = DataGenerator(store, seed=0)
+    model_generator = ModelGenerator(store)
+    for name in ["book", "message"]:
+        suite.add("modelgenerator generate_model %s" % name, lambda name=name: model_generator.generate_model(name))
+        kwargs = generator.random_value(name)
+        for compact in [False, True]:
+            model = model_generator.generate_model(name, compact=compact)
+            suite.add("modelgenerator %s %s(**kwargs)" % ("CompactModel" if compact else "Model", name),
+                      lambda model=model, kwargs=kwargs: model(**kwargs))
+
+
+def bench_schemasstore(suite, store, count):
+    folder = tempfile.mkdtemp(prefix="apitools-schemas-")
+    try:
+        write_schemas(folder, count)
+        cache_path = os.path.join(folder, "cache")
+
+        def load(lazy=False, cache_path=None):
+            store = SchemasStore(lazy=lazy, cache_path=cache_path)
+            store.load_folder(folder)
+            return store
+
+        suite.add("schemasstore load_folder %d schemas" % count, load)
+        suite.add("schemasstore load_folder %d schemas lazy" % count, lambda: load(lazy=True))
+        load(cache_path=cache_path)
+        suite.add("schemasstore load_folder %d schemas cached" % count, lambda: load(cache_path=cache_path))
+
+        loaded = load()
+        last = "synthetic_%d" % (count - 1)
+        def resolve():
+            loaded.clear_resolved()
+            return loaded.resolved(last)
+        suite.add("schemasstore resolved chain of %d schemas" % count, resolve)
+        suite.add("schemasstore resolved chain of %d schemas lazy" % count,
+                  lambda: load(lazy=True).resolved(last))
+    finally:
+        shutil.rmtree(folder)
+
+
+def bench_resourceserver(suite, store, rows):
+    try:
+        from .resourceserver import ResourceServer
+    except ImportError as error:
+        suite.skip("resourceserver", error)
+        return
+
+    folder = tempfile.mkdtemp(prefix="apitools-server-")
+    server = ResourceServer(database_uri="sqlite:///%s" % os.path.join(folder, "benchmark.db"))
+    try:
+        # flask-sqlalchemy needs an application context outside of the requests
+        with server.app.app_context():
+            # the model generator adds the implicit key to the schema
+            server.add_resource(copy.deepcopy(store.schema("message", True)))
+            server.db.create_all()
+            model = server.message
+
+            generator = DataGenerator(store, seed=0)
+            server.add_all(model, [model(**values) for values in generator.generate_many("message", rows)])
+            client = server.app.test_client()
+
+            etag = client.get("/messages/1").headers["ETag"]
+            body = json.dumps(generator.random_value("message"))
+            bulk_body = json.dumps(generator.generate_many("message", 100))
+            suite.add("resourceserver GET self", lambda: client.get("/messages/1"))
+            suite.add("resourceserver GET self 304", lambda: client.get("/messages/1", headers={"If-None-Match":etag}))
+            cache = server.response_cache
+            server.response_cache = utils.ResponseCache(0)
+            suite.add("resourceserver GET self uncached", lambda: client.get("/messages/1"))
+            server.response_cache = cache
+            suite.add("resourceserver OPTIONS self", lambda: client.open("/messages/1", method="OPTIONS"))
+            suite.add("resourceserver GET instances limit=100", lambda: client.get("/messages?limit=100"))
+            suite.add("resourceserver GET instances %d rows" % rows, lambda: client.get("/messages"))
+            suite.add("resourceserver GET instances %d rows ndjson" % rows,
+                      lambda: client.get("/messages?stream=ndjson").data)
+            suite.add("resourceserver PUT self",
+                      lambda: client.put("/messages/2", data=body, content_type="application/json"))
+            suite.add("resourceserver POST create",
+                      lambda: client.post("/messages", data=body, content_type="application/json"))
+            suite.add("resourceserver POST create 100 items",
+                      lambda: client.post("/messages", data=bulk_body, content_type="application/json"))
+            server.db.session.remove()
+            server.db.engine.dispose()
+    finally:
+        shutil.rmtree(folder)
+
+
+# name -> function adding the benchmarks of a group to a suite
+groups = {
+    "datagenerator":lambda suite, store, opts: bench_datagenerator(suite, store),
+    "invaliddatagenerator":lambda suite, store, opts: bench_invaliddatagenerator(suite, store),
+    "validation":lambda suite, store, opts: bench_validation(suite, store),
+    "modelgenerator":lambda suite, store, opts: bench_modelgenerator(suite, store),
+    "schemasstore":lambda suite, store, opts: bench_schemasstore(suite, store, opts.schemas),
+    "resourceserver":lambda suite, store, opts: bench_resourceserver(suite, store, opts.rows),
+}
+
+
+def format_time(seconds):
+    for unit, scale in [("s", 1), ("ms", 1e-3), ("us", 1e-6)]:
+        if seconds >= scale:
+            return "%.2f %s" % (seconds / scale, unit)
+    return "%.0f ns" % (seconds / 1e-9)
+
+
+def format_result(name, result):
+    return "%-60s %12s +- %-10s (%d x %d)" % (
+        name, format_time(result["best"]), format_time(result["stdev"]), result["repeat"], result["number"])
+
+
+def compare(previous, current, threshold=0.1):
+    """Returns the lines comparing the best times of two reports, the changes
+    greater than threshold (a fraction) are marked as slower or faster"""
+    lines = ["%-60s %12s %12s %8s" % ("benchmark", "previous", "current", "ratio")]
+    for name, result in sorted(current["benchmarks"].items()):
+        old = previous["benchmarks"].get(name)
+        if old is None:
+            lines.append("%-60s %12s %12s" % (name, "-", format_time(result["best"])))
+            continue
+        ratio = result["best"] / old["best"]
+        mark = ""
+        if ratio > 1 + threshold:
+            mark = "slower"
+        elif ratio < 1 - threshold:
+            mark = "faster"
+        lines.append("%-60s %12s %12s %7.2fx %s" % (
+            name, format_time(old["best"]), format_time(result["best"]), ratio, mark))
+    return lines
+
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser(usage="usage: %prog [--out results.json] [--compare previous.json] [group...]")
+    parser.add_option('-o', '--out', help='File to write the results to as json', dest='out', action='store')
+    parser.add_option('-c', '--compare', help='Results of a previous run to compare with', dest='compare', action='store')
+    parser.add_option('-k', '--select', help='Only run the benchmarks with this in their name, can be repeated',
+                      default=[], dest='selected', action='append')
+    parser.add_option('-r', '--repeat', help='Number of measures of each benchmark', default=5, type='int', dest='repeat', action='store')
+    parser.add_option('-t', '--min-time', help='Minimum duration of a measure in seconds', default=0.2, type='float',
+                      dest='min_time', action='store')
+    parser.add_option('--schemas', help='Number of schemas loaded by the schemasstore benchmarks', default=2000, type='int',
+                      dest='schemas', action='store')
+    parser.add_option('--rows', help='Number of rows in the resourceserver database', default=1000, type='int',
+                      dest='rows', action='store')
+    parser.add_option('--threshold', help='Ratio change reported as slower or faster by --compare', default=0.1, type='float',
+                      dest='threshold', action='store')
+    (opts, args) = parser.parse_args()
+
+    for group in args:
+        if group not in groups:
+            parser.error("unknown group %s (%s)" % (group, ", ".join(sorted(groups))))
+
+    previous = None
+    if opts.compare:
+        with open(opts.compare) as f:
+            previous = json.load(f)
+
+    store = SchemasStore()
+    store.load_folder(schemas_folder)
+    suite = Suite(opts.repeat, opts.min_time, opts.selected)
+    for group, add_benchmarks in list(groups.items()):
+        if not args or group in args:
+            add_benchmarks(suite, store, opts)
+
+    report = suite.report()
+    if opts.out:
+        with open(opts.out, "w") as out:
+            json.dump(report, out, indent=2, sort_keys=True)
+    if previous is not None:
+        print("\n".join(compare(previous, report, opts.threshold)))
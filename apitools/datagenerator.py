@@ -1,14 +1,21 @@
+import collections
+import concurrent.futures
 import random
 import string
 import datetime
+import hashlib
+import json
+import optparse
 import os
 import sys
 
-sys.path.insert(0,os.path.join(os.path.dirname(__file__),"dependencies/rstr"))
+from .patterngenerator import compile_pattern
+from .schemasstore import SchemasStore, referenced_types
 
-from .schemasstore import SchemasStore
-
-import rstr
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 class DataGenerator:
     number_range = [-50,50]
@@ -20,23 +27,555 @@ class DataGenerator:
 
     basic_types = ["string", "boolean", "number", "integer"]
 
-    def __init__(self, schemas_store=None):
+    # maximum nesting of recursive types
+    max_depth = 5
+
+    def __init__(self, schemas_store=None, seed=None):
         self.schemas_store = schemas_store
+        self.listened_store = None
+        self.recursion_depth = 0
+        self.seed(seed)
+
+    def seed(self, seed=None):
+        """Seeds the generator's own random number generators, the same seed
+        generates the same values"""
+        self.random = random.Random(seed)
+        self.numpy_random = numpy.random.default_rng(seed) if numpy else None
+        # compiled generators are bound to the previous random generator
+        self.compiled_cache = {}
+
+    def schemas_changed(self, names):
+        """Drops the compiled generators using the changed schemas"""
+        for type_name, (fn, used_types) in list(self.compiled_cache.items()):
+            if used_types & names:
+                self.compiled_cache.pop(type_name, None)
 
     def random_value(self, schema):
         if isinstance(schema, str):
-            schema = self.get_schema(schema)
-        method = getattr(self, "random_%s"%schema["type"])
+            return self.compile(schema)()
+        method = getattr(self, "random_%s"%schema["type"], None)
+        if not method:
+            # named type
+            return self.compile(schema["type"])()
 
         return method(schema)
 
+    def compile(self, schema):
+        """Walks the schema once and returns a function generating random
+        values for it. Type names, bounds and dispatch are resolved upfront
+        so each call only pays for the random draws.
+        Generators compiled for a type name are cached until the schemas
+        they use change in the store."""
+        if not isinstance(schema, str):
+            return self._compile(schema, {})
+
+        # the entry may be dropped by schemas_changed from the watching thread
+        entry = self.compiled_cache.get(schema)
+        if entry is None:
+            compiled = {}
+            if self.schemas_store:
+                if self.listened_store is not self.schemas_store:
+                    self.schemas_store.add_listener(self.schemas_changed)
+                    self.listened_store = self.schemas_store
+                # a reload can't change the schemas while they are compiled
+                with self.schemas_store.lock:
+                    fn = self._compile(schema, compiled)
+            else:
+                fn = self._compile(schema, compiled)
+            entry = self.compiled_cache[schema] = (fn, set(compiled))
+        return entry[0]
+
+    def _compile(self, schema, compiled):
+        if isinstance(schema, str):
+            type_name = schema
+            if type_name in compiled:
+                # already compiled or being compiled (recursive type),
+                # resolve it when generating
+                return self.bounded(lambda: compiled[type_name]())
+            compiled[type_name] = None
+            schema = self.get_schema(type_name)
+            if not schema:
+                raise Exception("Don't know how to generate '%s'"%type_name)
+            fn = compiled[type_name] = self._compile(schema, compiled)
+            return fn
+
+        method = getattr(self, "compile_%s"%schema["type"], None)
+        if not method:
+            # not a basic type, try to find it in the store
+            return self._compile(schema["type"], compiled)
+        return method(schema, compiled)
+
+    def bounded(self, fn):
+        """Wraps a recursive reference so it fails with MaxDepthReached
+        when nested more than max_depth times"""
+        def recursive():
+            if self.recursion_depth >= self.max_depth:
+                raise MaxDepthReached(self.max_depth)
+            self.recursion_depth += 1
+            try:
+                return fn()
+            finally:
+                self.recursion_depth -= 1
+        return recursive
+
+    def compile_number(self, schema, compiled=None):
+        minimum = schema.get("minimum", self.number_range[0])
+        maximum = schema.get("maximum", self.number_range[1])
+
+        if minimum > maximum:
+            maximum = minimum
+
+        uniform = self.random.uniform
+        return lambda: uniform(minimum, maximum)
+
+    def integer_bounds(self, schema):
+        """Returns (low, high, step) so that the valid integers are
+        step*[low, high]"""
+        minimum = schema.get("minimum", self.number_range[0])
+        maximum = schema.get("maximum", self.number_range[1])
+        divisible_by = schema.get("divisibleBy", 1)
+
+        if schema.get("exclusiveMinimum",False):
+            minimum += 1
+
+        if schema.get("exclusiveMaximum", False):
+            maximum -= 1
+
+        if divisible_by == 0:
+            raise Exception("Can't generate a number divisible by 0")
+
+        if minimum > maximum:
+            maximum = minimum
+
+        # only draw multiples of divisible_by inside [minimum, maximum]
+        step = abs(divisible_by)
+        low = -(-minimum // step)
+        high = maximum // step
+        if low > high:
+            high = low
+        return low, high, step
+
+    def compile_integer(self, schema, compiled=None):
+        low, high, step = self.integer_bounds(schema)
+
+        randint = self.random.randint
+        if step == 1:
+            return lambda: randint(low, high)
+        return lambda: randint(low, high)*step
+
+    def compile_boolean(self, schema, compiled=None):
+        getrandbits = self.random.getrandbits
+        return lambda: bool(getrandbits(1))
+
+    def compile_string(self, schema, compiled=None):
+        if "enum" in schema:
+            choice = self.random.choice
+            values = list(schema["enum"])
+            return lambda: choice(values)
+
+        if "format" in schema:
+            method_name = ("random_string_%s" % schema["format"]).replace("-", "")
+            method = getattr(self, method_name, None)
+            if callable(method):
+                return lambda: method(schema)
+
+        if "pattern" in schema:
+            generate = compile_pattern(schema["pattern"]).generate
+            rng = self.random
+            return lambda: generate(rng)
+
+        min_length = schema.get("minLength", self.string_range[0])
+        max_length = schema.get("maxLength", self.string_range[1])
+
+        if min_length > max_length:
+            max_length = min_length
+
+        randint = self.random.randint
+        choices = self.random.choices
+        charset = self.string_charset
+        return lambda: ''.join(choices(charset, k=randint(min_length, max_length)))
+
+    def compile_array(self, schema, compiled=None):
+        if compiled is None:
+            compiled = {}
+
+        items_type, items_schema = self.get_items_schema(schema)
+        if items_type in self.basic_types or items_type == "object":
+            item = self._compile(items_schema, compiled)
+        else:
+            item = self._compile(items_type, compiled)
+
+        unique = schema.get("uniqueItems", False)
+        domain = self.unique_domain(items_schema) if unique else None
+        # bounds by recursion depth, the default size shrinks in nested recursive types
+        bounds = [self.array_bounds(schema, depth, domain) for depth in range(self.max_depth + 1)]
+        # the real lower bound, the defaults may end in an empty array when too deep
+        required_items = schema.get("minItems", 0)
+
+        randint = self.random.randint
+        depth_bounds = lambda: bounds[min(self.recursion_depth, self.max_depth)]
+
+        if unique:
+            unique_items = self.unique_items
+
+            def unique_array():
+                try:
+                    return unique_items(item, randint(*depth_bounds()), domain)
+                except MaxDepthReached:
+                    # too deep in a recursive type, stop if allowed
+                    if required_items:
+                        raise
+                    return []
+            return unique_array
+
+        def array():
+            try:
+                return [item() for x in range(randint(*depth_bounds()))]
+            except MaxDepthReached:
+                if required_items:
+                    raise
+                return []
+        return array
+
+    def array_bounds(self, schema, depth=0, domain=None):
+        """Returns the bounds of the number of items of an array nested in
+        depth recursive types, the default bounds are halved at each level"""
+        min_items = schema.get("minItems", self.array_range[0] >> depth)
+        max_items = schema.get("maxItems", self.array_range[1] >> depth)
+
+        if min_items > max_items:
+            max_items = min_items
+
+        if domain is not None:
+            min_items, max_items = self.unique_range(schema, min_items, max_items, domain)
+        return min_items, max_items
+
+    def unique_range(self, schema, min_items, max_items, domain):
+        """Returns the bounds of the number of unique items drawn from domain,
+        the default bounds are limited to the number of possible values"""
+        if "minItems" not in schema:
+            min_items = min(min_items, len(domain))
+        if min_items > len(domain):
+            raise Exception("Can't generate %d unique items, only %d possible values" % (
+                min_items, len(domain)))
+        return min_items, min(max_items, len(domain))
+
+    def unique_domain(self, schema):
+        """Returns all the possible values of the schema if they can be
+        enumerated cheaply (bounded integers, booleans, enums), None otherwise"""
+        if "enum" in schema:
+            unique = []
+            keys = set()
+            for value in schema["enum"]:
+                if hashable_key(value) not in keys:
+                    keys.add(hashable_key(value))
+                    unique.append(value)
+            return unique
+        if schema.get("type") == "integer":
+            low, high, step = self.integer_bounds(schema)
+            return range(low*step, high*step+1, step)
+        if schema.get("type") == "boolean":
+            return [False, True]
+        return None
+
+    def unique_items(self, generate, count, domain=None):
+        """Returns count unique values. Values are sampled without
+        replacement from domain if given, generated with generate and
+        deduplicated otherwise"""
+        if domain is not None:
+            if count > len(domain):
+                raise Exception("Can't generate %d unique items, only %d possible values" % (
+                    count, len(domain)))
+            return self.random.sample(domain, count)
+
+        max_tries = 100
+        res = []
+        keys = set()
+        for x in range(count):
+            tries = 0
+            while True:
+                obj = generate()
+                key = hashable_key(obj)
+                if key not in keys:
+                    break
+                tries += 1
+                if tries > max_tries:
+                    raise Exception("Failed to generate the required number of unique items")
+            keys.add(key)
+            res.append(obj)
+        return res
+
+    def compile_object(self, schema, compiled=None):
+        if compiled is None:
+            compiled = {}
+
+        required = schema.get("required", [])
+        if not isinstance(required, list):
+            required = []
+
+        # not required properties are generated with not_required_probability
+        properties = []
+        for prop_name, prop_schema in list(schema.get("properties", {}).items()):
+            prop_required = prop_schema.get("required", False) or prop_name in required
+            properties.append((prop_name, self._compile(prop_schema, compiled), prop_required))
+
+        rand = self.random.random
+        probability = self.not_required_probability
+
+        def random_object():
+            obj = {}
+            for prop_name, prop_fn, prop_required in properties:
+                if prop_required or rand() <= probability:
+                    try:
+                        obj[prop_name] = prop_fn()
+                    except MaxDepthReached:
+                        # too deep in a recursive type, skip it if allowed
+                        if prop_required:
+                            raise
+            return obj
+        return random_object
+
+    def generate_many(self, schema, count, columnar=False):
+        """Generates count values of the schema, drawing the values of each
+        leaf property for all the instances in one go using numpy.
+        With columnar=True, objects are returned as a dict of lists
+        (None where a property wasn't generated) instead of a list of dicts.
+        Falls back to a compiled generator if numpy isn't available or for
+        recursive types."""
+        if numpy is None or self.is_recursive(schema):
+            generate = self.compile(schema)
+            values = [generate() for x in range(count)]
+            if columnar:
+                return self._to_columns(schema, values)
+            return values
+
+        return self._many(schema, count, columnar)
+
+    def is_recursive(self, schema):
+        """Returns True if the schema uses a recursive type"""
+        if not self.schemas_store:
+            return False
+        if isinstance(schema, str):
+            schema = {"type": schema}
+
+        names = list(referenced_types(schema))
+        graph = self.schemas_store.dependency_graph(names)
+        recursive = self.schemas_store.recursive_types(names)
+        seen = set()
+        while names:
+            name = names.pop()
+            if name in recursive:
+                return True
+            if name not in seen and name in graph:
+                seen.add(name)
+                names.extend(graph[name])
+        return False
+
+    def _to_columns(self, schema, values):
+        if isinstance(schema, str):
+            schema = self.get_schema(schema)
+        if schema["type"] != "object":
+            return values
+        return dict((prop_name, [value.get(prop_name) for value in values])
+                    for prop_name in schema.get("properties", {}))
+
+    def _many(self, schema, count, columnar=False):
+        if isinstance(schema, str):
+            type_name = schema
+            schema = self.get_schema(type_name)
+            if not schema:
+                raise Exception("Don't know how to generate '%s'"%type_name)
+
+        method = getattr(self, "many_%s"%schema["type"], None)
+        if not method:
+            return self._many(schema["type"], count, columnar)
+        if schema["type"] == "object":
+            return method(schema, count, columnar)
+        return method(schema, count)
+
+    def many_number(self, schema, count):
+        minimum = schema.get("minimum", self.number_range[0])
+        maximum = schema.get("maximum", self.number_range[1])
+
+        if minimum > maximum:
+            maximum = minimum
+
+        return self.numpy_random.uniform(minimum, maximum, count).tolist()
+
+    def many_integer(self, schema, count):
+        low, high, step = self.integer_bounds(schema)
+        values = self.numpy_random.integers(low, high, count, endpoint=True)
+        if step != 1:
+            values *= step
+        return values.tolist()
+
+    def many_boolean(self, schema, count):
+        return self.numpy_random.integers(0, 2, count).astype(bool).tolist()
+
+    def many_string(self, schema, count):
+        if "enum" in schema:
+            values = schema["enum"]
+            return [values[i] for i in self.numpy_random.integers(0, len(values), count).tolist()]
+
+        if "pattern" in schema and "format" not in schema:
+            return compile_pattern(schema["pattern"]).generate_many(self.random, count)
+
+        if "format" in schema:
+            # no vectorized version of these
+            generate = self.compile_string(schema)
+            return [generate() for x in range(count)]
+
+        min_length = schema.get("minLength", self.string_range[0])
+        max_length = schema.get("maxLength", self.string_range[1])
+
+        if min_length > max_length:
+            max_length = min_length
+
+        # draw all the characters at once and cut them into strings
+        lengths = self.numpy_random.integers(min_length, max_length, count, endpoint=True)
+        ends = numpy.cumsum(lengths).tolist()
+        charset = numpy.frombuffer(self.string_charset.encode("utf-8"), dtype=numpy.uint8)
+        indexes = self.numpy_random.integers(0, len(charset), ends[-1] if ends else 0)
+        chars = charset[indexes].tobytes().decode("utf-8")
+        return [chars[end-length:end] for end, length in zip(ends, lengths.tolist())]
+
+    def many_array(self, schema, count):
+        items_type, items_schema = self.get_items_schema(schema)
+
+        if schema.get("uniqueItems", False):
+            generate = self.compile_array(schema)
+            return [generate() for x in range(count)]
+
+        min_items = schema.get("minItems", self.array_range[0])
+        max_items = schema.get("maxItems", self.array_range[1])
+
+        if min_items > max_items:
+            max_items = min_items
+
+        # generate the items of all the arrays at once and split them
+        sizes = self.numpy_random.integers(min_items, max_items, count, endpoint=True)
+        ends = numpy.cumsum(sizes).tolist()
+        items = self._many(items_schema, ends[-1] if ends else 0)
+        return [items[end-size:end] for end, size in zip(ends, sizes.tolist())]
+
+    def many_object(self, schema, count, columnar=False):
+        required = schema.get("required", [])
+        if not isinstance(required, list):
+            required = []
+
+        columns = {}
+        for prop_name, prop_schema in list(schema.get("properties", {}).items()):
+            if prop_schema.get("required", False) or prop_name in required:
+                columns[prop_name] = (None, self._many(prop_schema, count))
+            else:
+                # only generate values for the instances having the property
+                present = numpy.flatnonzero(
+                    self.numpy_random.random(count) <= self.not_required_probability).tolist()
+                columns[prop_name] = (present, self._many(prop_schema, len(present)))
+
+        if columnar:
+            res = {}
+            for prop_name, (present, values) in list(columns.items()):
+                if present is None:
+                    res[prop_name] = values
+                else:
+                    column = res[prop_name] = [None] * count
+                    for i, value in zip(present, values):
+                        column[i] = value
+            return res
+
+        objs = [{} for x in range(count)]
+        for prop_name, (present, values) in list(columns.items()):
+            if present is None:
+                for obj, value in zip(objs, values):
+                    obj[prop_name] = value
+            else:
+                for i, value in zip(present, values):
+                    objs[i][prop_name] = value
+        return objs
+
+    def iter_values(self, schema, count=None, chunk_size=1000):
+        """Yields count values of the schema, or an infinite stream if
+        count is None. Values are generated chunk_size at a time so memory
+        use doesn't depend on count."""
+        while count is None or count > 0:
+            size = chunk_size if count is None else min(chunk_size, count)
+            for value in self.generate_many(schema, size):
+                yield value
+            if count is not None:
+                count -= size
+
+    def write_ndjson(self, schema, out, count=None, chunk_size=1000):
+        """Writes count values of the schema to the file object out as
+        newline-delimited json, one chunk of chunk_size values at a time"""
+        chunk = []
+        for value in self.iter_values(schema, count, chunk_size):
+            chunk.append(json.dumps(value))
+            if len(chunk) == chunk_size:
+                out.write("\n".join(chunk) + "\n")
+                chunk = []
+        if chunk:
+            out.write("\n".join(chunk) + "\n")
+        out.flush()
+
+    def write_ndjson_parallel(self, schema, out, count=None, seed=None, workers=None, chunk_size=1000):
+        """Same as write_ndjson but generates the chunks in worker processes.
+        Each chunk gets its own generator seeded from seed and its index, so
+        the same seed and count always give the same output whatever the
+        number of workers."""
+        if seed is None:
+            seed = self.random.getrandbits(64)
+
+        workers = workers or os.cpu_count() or 1
+        max_pending = 2 * workers
+
+        def chunks():
+            index = 0
+            remaining = count
+            while remaining is None or remaining > 0:
+                size = chunk_size if remaining is None else min(chunk_size, remaining)
+                yield (chunk_seed(seed, index), size)
+                index += 1
+                if remaining is not None:
+                    remaining -= size
+
+        # keep a bounded number of chunks in flight and write them in order
+        with concurrent.futures.ProcessPoolExecutor(
+                workers, initializer=_init_worker,
+                initargs=(self.__class__, self.schemas_store, schema)) as executor:
+            pending = collections.deque()
+            for args in chunks():
+                pending.append(executor.submit(_generate_chunk, *args))
+                if len(pending) >= max_pending:
+                    out.write(pending.popleft().result())
+            while pending:
+                out.write(pending.popleft().result())
+        out.flush()
+
     def get_schema(self, type_name):
         if type_name in self.basic_types:
             return {"type":type_name}
         if self.schemas_store:
-            return self.schemas_store.schema(type_name, True)
+            return self.schemas_store.resolved(type_name)
         return None
 
+    def get_items_schema(self, schema):
+        """Returns the type name and schema of the items of an array,
+        constraints on basic types are kept"""
+        items_type = schema["items"]["type"]
+        if items_type == 'object':
+            if "name" not in schema["items"]:
+                # inline object
+                return items_type, schema["items"]
+            items_type = schema["items"]["name"]
+        if items_type in self.basic_types:
+            return items_type, schema["items"]
+
+        items_schema = self.get_schema(items_type)
+        if not items_schema:
+            raise Exception("Don't know how to generate '%s'"%items_type)
+        return items_type, items_schema
+
     def random_number(self, schema=dict()):
         minimum = schema.get("minimum", self.number_range[0])
         maximum = schema.get("maximum", self.number_range[1])
@@ -44,7 +583,7 @@ class DataGenerator:
         if minimum > maximum:
             maximum = minimum
 
-        return random.uniform(minimum, maximum)
+        return self.random.uniform(minimum, maximum)
 
     def random_schema(self):
         schema = {"properties":{}, "type":"object"}
@@ -52,7 +591,7 @@ class DataGenerator:
 
         nb_properties = self.random_integer({"minimum":1,"maximum":5})
         for i in range(nb_properties):
-            prop_type = random.choice([
+            prop_type = self.random.choice([
                 "number",
                 "boolean",
                 "integer",
@@ -87,17 +626,17 @@ class DataGenerator:
         if minimum > maximum:
             maximum = minimum
 
-        return random.randint(minimum/abs(divisible_by), maximum/abs(divisible_by))*divisible_by
+        return self.random.randint(minimum/abs(divisible_by), maximum/abs(divisible_by))*divisible_by
 
     def random_boolean(self, schema=dict()):
-        return bool(random.getrandbits(1))
+        return bool(self.random.getrandbits(1))
 
     def random_string(self, schema=dict()):
         pattern = schema.get("pattern",None)
 
         if "enum" in schema:
             size = len(schema["enum"])
-            rand = random.randint(0, size-1)
+            rand = self.random.randint(0, size-1)
             return schema["enum"][rand]
 
         if "format" in schema:
@@ -109,7 +648,7 @@ class DataGenerator:
                 return method(schema)
 
         if "pattern" in schema:
-            return rstr.xeger(schema["pattern"])
+            return compile_pattern(schema["pattern"]).generate(self.random)
 
         min_length = schema.get("minLength", self.string_range[0])
         max_length = schema.get("maxLength", self.string_range[1])
@@ -117,8 +656,8 @@ class DataGenerator:
         if min_length > max_length:
             max_length = min_length
 
-        length = random.randint(min_length, max_length)
-        return ''.join(random.choice(self.string_charset)
+        length = self.random.randint(min_length, max_length)
+        return ''.join(self.random.choice(self.string_charset)
                        for x in range(length))
 
     def random_string_date(self, schema):
@@ -128,7 +667,7 @@ class DataGenerator:
         start = datetime.datetime(1900, 1, 1)
         end = datetime.datetime(2099, 12, 31)
         random_datetime = start + datetime.timedelta(
-            seconds=random.randint(0, int((end - start).total_seconds()))
+            seconds=self.random.randint(0, int((end - start).total_seconds()))
         )
         return random_datetime.strftime('%Y-%m-%d %H:%M')
 
@@ -158,84 +697,97 @@ class DataGenerator:
         pass
 
     def random_array(self, schema):
-        items_type = schema["items"]["type"]
-        if items_type == 'object':
-            items_schema = self.get_schema(schema["items"]["name"])
-        else:
-            items_schema = self.get_schema(items_type)
-        if not items_schema:
-            raise Exception("Don't know how to generate '%s'"%items_type)
-
-        min_items = schema.get("minItems", self.array_range[0])
-        max_items = schema.get("maxItems", self.array_range[1])
-
-        if min_items > max_items:
-            max_items = min_items
+        items_type, items_schema = self.get_items_schema(schema)
 
         unique_items = schema.get("uniqueItems", False)
+        domain = self.unique_domain(items_schema) if unique_items else None
+        count = self.random.randint(*self.array_bounds(schema, 0, domain))
 
-        count = random.randint(min_items, max_items)
+        if items_type in self.basic_types or items_type == "object":
+            generate = lambda: self.random_value(items_schema)
+        else:
+            # named types use their compiled generator, bounded if recursive
+            generate = self.compile(items_type)
 
         if unique_items:
-            max_tries = 100
-            res = []
-            for x in range(count):
-                tries = 0
-                while True:
-                    obj = self.random_value(items_schema)
-                    if obj not in res:
-                        break
-                    tries += 1
-                    if tries > max_tries:
-                        raise Exception("Failed to generate the required number of unique items")
-                res.append(obj)
-            return res
+            return self.unique_items(generate, count, domain)
 
-        return [self.random_value(items_schema) for x in range(count)]
+        return [generate() for x in range(count)]
 
     def random_object(self, schema):
         obj = {}
+        required = schema.get("required", [])
+        if not isinstance(required, list):
+            required = []
         props_list = list(schema.get("properties", {}).items())
         for prop_name, prop_schema in props_list:
             if prop_schema.get("required", False) or \
-               prop_name in schema.get("required") or \
-               random.random() <= self.not_required_probability:
+               prop_name in required or \
+               self.random.random() <= self.not_required_probability:
                 obj[prop_name] = self.random_value(prop_schema)
         return obj
 
 
-if __name__ == "__main__":
+class MaxDepthReached(Exception):
+    def __init__(self, max_depth):
+        Exception.__init__(self, "Can't generate a recursive type within %d levels" % max_depth)
 
-    generator = DataGenerator()
 
-    # Generates random instances of basic types
-    for basic_type in generator.basic_types:
-        print(generator.random_value(basic_type))
+def hashable_key(value):
+    """Returns a hashable value equal for equal json values, with the type
+    so 1, 1.0 and True stay distinct"""
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, sort_keys=True)
+    return (type(value).__name__, value)
 
-    # Same with basic properties
-    print(generator.random_value({"type":"number", "minimum":50}))
-    print(generator.random_value({"type":"integer", "divisibleBy":-23, "minimum":-69}))
-    print(generator.random_value({"type":"string", "maxLength":20, "minLength":15}))
 
-    # Generates a random array of string
-    print(generator.random_value({"type":"array", "items": {"type":"string"}}))
+def chunk_seed(seed, index):
+    """Derives the seed of a chunk from the master seed"""
+    digest = hashlib.sha256(("%s:%d" % (seed, index)).encode("utf-8")).hexdigest()
+    return int(digest[:16], 16)
 
-    store = SchemasStore()
-    store.load_folder("data/schemas/")
-    generator.schemas_store = store
 
-    # Generate a random object defined in data/schemas/search_results.json
-    print(generator.random_value("search_results"))
+_worker = {}
 
-    # Generates an array of search_result
-    print(generator.random_value({"type":"array", "items":{"type":"search_result"}}))
+def _init_worker(generator_class, schemas_store, schema):
+    _worker["generator"] = generator_class(schemas_store)
+    _worker["schema"] = schema
 
-    store.add_schema({"type":"integer", "name":"small_integer", "minimum":0,"maximum":9})
-    print(generator.random_value({"type":"array", "uniqueItems":True, "minItems":10, "items":{"type":"small_integer"}}))
+def _generate_chunk(seed, size):
+    generator = _worker["generator"]
+    generator.seed(seed)
+    values = generator.generate_many(_worker["schema"], size)
+    return "".join(json.dumps(value) + "\n" for value in values)
 
-    print(generator.random_value({"type":"string", "pattern": "^[a-zA-Z]{10}[0-5]{,7}$"}))
 
-    r_schema = generator.random_schema()
-    print(r_schema)
+if __name__ == "__main__":
+    parser = optparse.OptionParser(usage="usage: %prog --schema name [--count N] [--out file.ndjson]")
+    parser.add_option('-s', '--schema', help='Name of the schema to generate', dest='schema', action='store')
+    parser.add_option('-n', '--count', help='Number of values to generate, infinite if omitted', type='int', dest='count', action='store')
+    parser.add_option('-o', '--out', help='Output file, stdout if omitted', dest='out', action='store')
+    parser.add_option('-f', '--folder', help='Folder to load the schemas from',
+                      default=os.path.join(os.path.dirname(__file__), "data/schemas"), dest='folder', action='store')
+    parser.add_option('-c', '--chunk-size', help='Number of values generated and written at once',
+                      default=1000, type='int', dest='chunk_size', action='store')
+    parser.add_option('-r', '--seed', help='Seed of the generation, the same seed gives the same output',
+                      type='int', dest='seed', action='store')
+    parser.add_option('-w', '--workers', help='Number of worker processes', type='int', dest='workers', action='store')
+    (opts, args) = parser.parse_args()
+
+    if not opts.schema:
+        parser.error("--schema is required")
 
-    print(generator.random_value(r_schema))
+    store = SchemasStore()
+    store.load_folder(opts.folder)
+    generator = DataGenerator(store)
+
+    out = open(opts.out, "w") if opts.out else sys.stdout
+    try:
+        if opts.seed is not None or opts.workers:
+            generator.write_ndjson_parallel(opts.schema, out, opts.count, opts.seed,
+                                            opts.workers, opts.chunk_size)
+        else:
+            generator.write_ndjson(opts.schema, out, opts.count, opts.chunk_size)
+    finally:
+        if out is not sys.stdout:
+            out.close()
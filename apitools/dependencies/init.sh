@@ -1,2 +0,0 @@
-#!/bin/sh
-hg clone https://bitbucket.org/leapfrogdevelopment/rstr
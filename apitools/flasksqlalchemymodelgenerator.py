@@ -1,30 +1,47 @@
-from flask import Flask
-from flask.ext.sqlalchemy import SQLAlchemy, orm
+from sqlalchemy import orm
 
 from .modelgenerator import ModelGenerator, UnknownPropertyError, MissingRequiredPropertyError
 from .validation import generate_validator_for_property, ValidationError
 
 class FlaskSQLAlchemyModelGenerator(ModelGenerator):
 
-    def __init__(self):
-        ModelGenerator.__init__(self)
+    def __init__(self, schemas_store=None, cache_dir=None):
+        ModelGenerator.__init__(self, schemas_store, cache_dir)
 
-    def generate(self, db, schema):
+    def generate(self, db, schema, codegen=False):
+        """Generates the model of schema using db.Model as base class and
+        db.Column and the db types, as provided by flask-sqlalchemy.
+        Models generated from the name of a schema of the store follow the
+        changes of its validators."""
+        name = schema if isinstance(schema, str) else None
+        schema = self.get_schema(schema)
 
-        attribs = ModelGenerator.generate(self, schema)
+        attribs = ModelGenerator.generate(self, schema, codegen)
         key_name = attribs["key_name"]
         properties = schema.get("properties",{})
 
-        # add columns and validators from the schema properties
+        # add columns and validators from the schema properties,
+        # the validators are looked up when validating so they can be replaced
+        validators = {}
         for property_name, property_schema in list(properties.items()):
             attribs[property_name] = self.generate_column(db, property_schema, 
                                                           property_name==key_name)
 
             validator = generate_validator_for_property(property_name, property_schema)
             if validator:
-                attribs[validator.__name__] = orm.validates(property_name)(validator)
+                validators[property_name] = validator
+
+        def validate_property(obj, key, value):
+            validator = validators.get(key)
+            return validator(obj, key, value) if validator else value
+        attribs["__validators"] = validators
+        attribs["__properties"] = properties
+        if properties:
+            attribs["validate_property"] = orm.validates(*properties)(validate_property)
 
         model = type(str(schema["name"]),(db.Model,), attribs)
+        if name:
+            self.track(name, model)
         return model
 
     def generate_column(self, db, schema, primary):
@@ -37,10 +54,13 @@ class FlaskSQLAlchemyModelGenerator(ModelGenerator):
 
         # create the column
         required = schema.get("required", False)
-        return db.Column(sqla_type, nullable=not required,primary_key=primary)
+        # primary keys are never null, even implicit ones generated by the database
+        return db.Column(sqla_type, nullable=not required and not primary, primary_key=primary)
 
 
 if __name__ == "__main__":
+    from flask import Flask
+    from flask.ext.sqlalchemy import SQLAlchemy
 
     app = Flask(__name__)
     app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:////tmp/test.db'
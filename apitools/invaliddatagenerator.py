@@ -1,103 +1,350 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-import random
-import re
+import collections
+import copy
+import hashlib
+import json
+import math
+import os
 import string
 from .datagenerator import DataGenerator
+from .patterngenerator import compile_pattern
+from .schemasstore import SchemasStore
+from .validation import json_pointer
+
+# removes a property when returned by a mutation, or absent property
+MISSING = object()
+
+# a value of another type for each type
+wrong_types = {
+      "string":7,
+      "integer":"7",
+      "number":"7.5",
+      "boolean":"true",
+      "object":[],
+      "array":{},
+      "null":0,
+}
+
+def schema_hash(schema):
+      """Returns the same hash for equal schemas, whatever the order of their keys"""
+      return hashlib.sha1(json.dumps(schema, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+def child_value(container, key):
+      if isinstance(container, dict):
+            return container.get(key, MISSING)
+      if isinstance(container, list) and isinstance(key, int) and key < len(container):
+            return container[key]
+      return MISSING
+
+def replace_value(document, path, value):
+      """Returns a copy of document with the value at path replaced, only
+      the containers on the path are copied"""
+      if not path:
+            return value
+      copied = list(document) if isinstance(document, list) else dict(document)
+      key = path[0]
+      if len(path) == 1:
+            if value is MISSING:
+                  del copied[key]
+            else:
+                  copied[key] = value
+      else:
+            copied[key] = replace_value(document[key], path[1:], value)
+      return copied
 
 class InvalidDataGenerator:
+      """Generates values not respecting a schema.
+      The invalid values of a schema are computed once and kept in an
+      LRU of corpus_cache_size schemas, keyed by a hash of the schema."""
 
       invalid_boolean_values = ["TRUE", "FALSE", "true ", "false ", 0, 1]
-      invalid_integer_values = ["1.0", "0.0", "-0.9999999999999", "0.9999999999999", 
+      invalid_integer_values = ["1.0", "0.0", "-0.9999999999999", "0.9999999999999",
                                 "1 ", " 34", "45 67", " 65 9 ", "45 str", "45str",
                                 "str 5", "str5",
                                 ]
       invalid_number_values = ["1.23 ", " 123.45", " 123.45 ", "123str.45"]
       invalid_non_string_values = [" ", "'", "&&", "||", "☃",">","</","<!--","*", ".", ""]
 
+      # values of the wrong type, concatenated once
+      boolean_type_values = tuple(invalid_boolean_values + invalid_integer_values +
+                                  invalid_number_values + invalid_non_string_values)
+      number_type_values = tuple(invalid_non_string_values + invalid_number_values +
+                                 invalid_boolean_values)
+      integer_type_values = number_type_values + tuple(invalid_integer_values)
+
+      # maximum number of strings not matching a pattern
       invalid_strings = 10
 
-      def __init__(self):
-            self.data_generator = DataGenerator()
+      corpus_cache_size = 256
 
-      def invalid_value(self, schema):
+      def __init__(self, schemas_store=None, seed=None):
+            self.schemas_store = schemas_store
+            self.data_generator = DataGenerator(schemas_store, seed=seed)
+            # schema hash -> tuple of invalid values
+            self.corpus_cache = collections.OrderedDict()
+
+      def get_schema(self, type_name):
+            if type_name in self.data_generator.basic_types:
+                  return {"type":type_name}
+            if self.schemas_store:
+                  return self.schemas_store.resolved(type_name)
+            return None
+
+      def corpus(self, schema):
+            """Returns the invalid values of the schema as a tuple, memoized"""
             if isinstance(schema, str):
                   schema = self.get_schema(schema)
+            key = schema_hash(schema)
+            if key in self.corpus_cache:
+                  self.corpus_cache.move_to_end(key)
+                  return self.corpus_cache[key]
+
             method = getattr(self, "invalid_%s"%schema["type"])
-            
-            return method(schema)
+            corpus = self.corpus_cache[key] = tuple(method(schema))
+            while len(self.corpus_cache) > self.corpus_cache_size:
+                  self.corpus_cache.popitem(last=False)
+            return corpus
 
-      def invalid_boolean(self, schema={}):
-            return self.invalid_boolean_values +\
-                self.invalid_integer_values +\
-                self.invalid_number_values +\
-                self.invalid_non_string_values
+      def iter_invalid(self, schema):
+            """Yields the invalid values of the schema"""
+            for value in self.corpus(schema):
+                  yield value
 
-      def invalid_number(self, schema={}):
+      def invalid_value(self, schema):
+            return list(self.corpus(schema))
 
-            invalids = self.invalid_non_string_values +\
-                self.invalid_number_values + self.invalid_boolean_values
+      def invalid_boolean(self, schema={}):
+            return list(self.boolean_type_values)
 
+      def number_violations(self, schema, step):
+            """Returns (rule, value) for the values just outside the minimum
+            and maximum, step is the smallest difference between two values"""
+            violations = []
             if "minimum" in schema:
-                  invalids.append(schema["minimum"] - 7)
-                  if "exclusiveMinimum" in schema:
-                        invalids.append(schema["minimum"])
+                  minimum = schema["minimum"]
+                  if schema.get("exclusiveMinimum"):
+                        violations.append(("exclusiveMinimum", minimum))
+                  violations.append(("minimum", minimum - step if step else math.nextafter(minimum, -math.inf)))
 
             if "maximum" in schema:
-                  invalids.append(schema["maximum"] + 7)
-                  if "exclusiveMaximum" in schema:
-                        invalids.append(schema["maximum"])         
+                  maximum = schema["maximum"]
+                  if schema.get("exclusiveMaximum"):
+                        violations.append(("exclusiveMaximum", maximum))
+                  violations.append(("maximum", maximum + step if step else math.nextafter(maximum, math.inf)))
+            return violations
 
-            return invalids
+      def integer_violations(self, schema):
+            violations = self.number_violations(schema, 1)
 
-      def invalid_integer(self, schema={}):
-            invalids = self.invalid_number(schema) + self.invalid_integer_values
-            
-            if "divisibleBy" in schema:
-                  invalids.append(schema["divisibleBy"]*7 + 4)
-            
-            return invalids
+            # a value in the range for the other constraints
+            low = high = None
+            if "minimum" in schema:
+                  low = math.floor(schema["minimum"]) + 1 if schema.get("exclusiveMinimum") \
+                        else math.ceil(schema["minimum"])
+            if "maximum" in schema:
+                  high = math.ceil(schema["maximum"]) - 1 if schema.get("exclusiveMaximum") \
+                        else math.floor(schema["maximum"])
+            value = low if low is not None else (high if high is not None else 0)
 
+            # not an integer
+            violations.append(("type", value + 0.5))
 
-      def invalid_string(self, schema={}):
-            invalids = []
+            # not divisible
+            divisible_by = schema.get("divisibleBy", 1)
+            if divisible_by != 1:
+                  for candidate in [value, value + 1, value - 1]:
+                        if candidate % divisible_by and (low is None or candidate >= low) \
+                                    and (high is None or candidate <= high):
+                              violations.append(("divisibleBy", candidate))
+                              break
+            return violations
+
+      def string_violations(self, schema):
+            violations = []
+
+            # a valid value, to keep the other constraints when changing the length
+            base = self.data_generator.random_string(schema) if "pattern" in schema else ""
 
             if "maxLength" in schema:
-                  local_schema=dict(schema)
-                  local_schema["maxLength"] = local_schema["minLength"] = schema["maxLength"]+1
-                  invalids.append(self.data_generator.random_string(local_schema))
+                  length = schema["maxLength"] + 1
+                  base_chars = base or "a"
+                  violations.append(("maxLength", (base_chars * (length // len(base_chars) + 1))[:length]))
 
             if "minLength" in schema and schema["minLength"] > 0:
-                  local_schema = dict(schema)
-                  local_schema["minLength"] = local_schema["maxLength"] = schema["minLength"]-1
-                  invalids.append(self.data_generator.random_string(local_schema))
+                  length = schema["minLength"] - 1
+                  violations.append(("minLength", base[:length] if len(base) >= length else "a" * length))
 
             if "pattern" in schema:
-                  pattern = schema["pattern"]
+                  violations += [("pattern", value) for value in self.pattern_mismatches(schema["pattern"])]
+            return violations
+
+      def invalid_number(self, schema={}):
+            return list(self.number_type_values) + [value for rule, value in self.number_violations(schema, 0)]
+
+      def invalid_integer(self, schema={}):
+            return list(self.integer_type_values) + [value for rule, value in self.integer_violations(schema)]
+
+      def invalid_string(self, schema={}):
+            return [value for rule, value in self.string_violations(schema)]
+
+      def invalid_object(self, schema={}):
+            """Returns documents each violating one constraint of a valid instance"""
+            plan = self.document_mutations(schema)
+            return [document for rule, pointer, document in self.mutate(plan, self.data_generator.compile(schema)())]
+
+      invalid_array = invalid_object
+
+      def iter_invalid_documents(self, schema, count=None):
+            """Yields (rule, json pointer, document) for documents violating
+            one constraint of the schema, count of them or forever.
+            A new valid instance is generated for each round of mutations,
+            only one document is in memory at a time."""
+            if isinstance(schema, str):
+                  generate = self.data_generator.compile(schema)
+                  schema = self.get_schema(schema)
+            else:
+                  generate = self.data_generator.compile(schema)
+            plan = self.document_mutations(schema)
+            if not plan:
+                  return
+
+            sent = 0
+            while count is None or sent < count:
+                  for mutation in self.mutate(plan, generate()):
+                        yield mutation
+                        sent += 1
+                        if sent == count:
+                              return
+
+      def mutate(self, plan, document):
+            """Yields (rule, json pointer, document) for the mutations of the plan
+            applicable to the document"""
+            for rule, path, pointer, change in plan:
+                  # the containers must exist, optional ones may not have been generated
+                  parent = document
+                  for key in path[:-1]:
+                        parent = child_value(parent, key)
+                        if parent is MISSING:
+                              break
+                  if parent is MISSING or not isinstance(parent, (dict, list)):
+                        continue
+                  if path and isinstance(parent, list) and path[-1] >= len(parent):
+                        continue
+
+                  value = change(child_value(parent, path[-1]) if path else document)
+                  if value is not None:
+                        yield rule, pointer, replace_value(document, path, value)
+
+      def document_mutations(self, schema, path=(), pointer=None):
+            """Returns the mutations violating each constraint of the schema as
+            (rule, path, json pointer, change), change returns the new value
+            from the current one, MISSING to remove it, or None if it can't be applied"""
+            if isinstance(schema, str) or schema.get("type") not in wrong_types:
+                  # recursive references and any are not mutated
+                  return []
+
+            json_path = json_pointer(pointer)
+            type_name = schema["type"]
+            mutations = [("type", path, json_path, lambda value, wrong=wrong_types[type_name]: copy.copy(wrong))]
 
-                  r_pattern = re.compile(pattern)
-                  
-                  if not r_pattern.match(""):
-                        invalids.append("")
+            if type_name == "object":
+                  properties = schema.get("properties", {})
+                  required = schema.get("required", [])
+                  if not isinstance(required, list):
+                        required = []
+                  for prop_name, prop_schema in sorted(properties.items()):
+                        prop_required = isinstance(prop_schema, dict) and prop_schema.get("required", False) \
+                                        or prop_name in required
+                        if prop_required:
+                              mutations.append(("required", path + (prop_name,), json_pointer((pointer, prop_name)),
+                                                lambda value: MISSING))
+                  if schema.get("additionalProperties", True) is False:
+                        unknown = "unknown"
+                        while unknown in properties:
+                              unknown = "_" + unknown
+                        mutations.append(("additionalProperties", path + (unknown,), json_pointer((pointer, unknown)),
+                                          lambda value: unknown))
+                  for prop_name, prop_schema in sorted(properties.items()):
+                        mutations += self.document_mutations(prop_schema, path + (prop_name,), (pointer, prop_name))
 
-                  found=0
-                  for i in range(100):
-                        length = random.randint(0,100)
-                        gen = ''.join(random.choice(string.printable) for x in range(length))
+            elif type_name == "array":
+                  items_type, items_schema = self.data_generator.get_items_schema(schema)
+                  generate_item = self.data_generator.compile(items_schema if items_type in self.data_generator.basic_types
+                                                              or items_type == "object" else items_type)
+                  # optional arrays may not have been generated
+                  min_items = schema.get("minItems", 0)
+                  if min_items > 0:
+                        mutations.append(("minItems", path, json_path,
+                                          lambda value: value[:min_items - 1] if isinstance(value, list) else None))
+                  if "maxItems" in schema:
+                        max_items = schema["maxItems"]
+                        mutations.append(("maxItems", path, json_path,
+                                          lambda value: value + [generate_item() for x in range(max_items + 1 - len(value))]
+                                          if isinstance(value, list) else None))
+                  if schema.get("uniqueItems", False):
+                        def duplicate(value, max_items=schema.get("maxItems")):
+                              if not isinstance(value, list) or not value:
+                                    return None
+                              if max_items is None or len(value) < max_items:
+                                    return value + value[:1]
+                              # replace the last item to keep the length
+                              return value[:-1] + value[:1] if len(value) >= 2 else None
+                        mutations.append(("uniqueItems", path, json_path, duplicate))
+                  if isinstance(items_schema, dict):
+                        mutations += self.document_mutations(items_schema, path + (0,), (pointer, 0))
 
-                        print(gen)
-                        if gen not in invalids and not r_pattern.match(gen):
+            elif type_name == "integer":
+                  mutations += self.constant_mutations(self.integer_violations(schema), path, json_path)
+            elif type_name == "number":
+                  mutations += self.constant_mutations(self.number_violations(schema, 0), path, json_path)
+            elif type_name == "string":
+                  # one mismatch of the pattern is enough for each document
+                  violations = self.string_violations(schema)
+                  pattern = [violation for violation in violations if violation[0] == "pattern"][:1]
+                  violations = [violation for violation in violations if violation[0] != "pattern"] + pattern
+                  mutations += self.constant_mutations(violations, path, json_path)
+            return mutations
 
-                              invalids.append(gen)
-                              found += 1
-                              if found == self.invalid_strings:
-                                    break
+      def constant_mutations(self, violations, path, json_path):
+            return [(rule, path, json_path, lambda value, invalid=invalid: invalid)
+                    for rule, invalid in violations]
+
+      def pattern_mismatches(self, pattern):
+            """Returns strings not matching the pattern, made by changing
+            the first or last character of matching strings, adding one
+            or removing one"""
+            regex = compile_pattern(pattern).regex
+            samples = compile_pattern(pattern).generate_many(self.data_generator.random, 3)
+
+            invalids = []
+            def add(candidate):
+                  if candidate not in invalids and not regex.match(candidate):
+                        invalids.append(candidate)
+                  return len(invalids) >= self.invalid_strings
+
+            if add(""):
+                  return invalids
+            for sample in samples:
+                  for candidate in [sample[:-1], sample[1:], sample + sample]:
+                        if add(candidate):
+                              return invalids
+                  for char in string.printable:
+                        if add(char + sample[1:]) or add(sample[:-1] + char) or add(sample + char):
+                              return invalids
             return invalids
 
-            
+
 
 if __name__ == "__main__":
       generator = InvalidDataGenerator()
       print(generator.invalid_number())
+      print(generator.invalid_integer({"minimum":3, "maximum":12, "exclusiveMaximum":True, "divisibleBy":3}))
       print(generator.invalid_string({"pattern":"^[a-zA-Z]*$"}))
+      print(generator.invalid_string({"pattern":"^\\d{12}(\\d|X)$", "minLength":13, "maxLength":13}))
 
+      store = SchemasStore()
+      store.load_folder(os.path.join(os.path.dirname(__file__), "data/schemas"))
+      generator = InvalidDataGenerator(store)
+      for rule, pointer, document in generator.iter_invalid_documents("book", 20):
+            print(rule, pointer, json.dumps(document))
@@ -0,0 +1,280 @@
+import asyncio
+import copy
+import json
+import optparse
+import os
+import random
+import time
+from urllib.parse import quote
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+from .datagenerator import DataGenerator
+from .modelgenerator import ModelGenerator
+from .schemasstore import SchemasStore
+from .urlgenerator import UrlGenerator
+from . import utils
+
+# relative weight of each operation in the mix
+default_weights = {
+    "get":50,
+    "instances":10,
+    "create":20,
+    "update":15,
+    "delete":5,
+}
+
+# link needed by each operation
+operation_links = {
+    "get":"self",
+    "update":"self",
+    "delete":"self",
+    "instances":"instances",
+    "create":"create",
+}
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+class Target:
+    """The requests of the operations on the resource of a schema.
+    The keys of the instances created are kept to get, update and delete
+    them, urls from UrlGenerator are used until some are created."""
+
+    def __init__(self, schema, data_generator, url_generator, rng):
+        self.name = schema["name"]
+        self.rng = rng
+        attribs = ModelGenerator().generate(copy.deepcopy(schema))
+        self.key_name = attribs["key_name"]
+        self.links = dict((rel, href) for rel, href in list(attribs["links"].items()) if rel != "root")
+        self.templates = dict((rel, utils.url_to_template(href)) for rel, href in list(self.links.items()))
+        self.generate = data_generator.compile(self.name)
+        self.keys = []
+
+        # the links are relative to the root and the key can be implicit,
+        # give UrlGenerator the links and properties of the model
+        self.urls = url_generator.generate_valid({
+            "properties":attribs["properties"],
+            "links":[{"rel":rel, "href":href} for rel, href in list(self.links.items())],
+        })
+
+    def operations(self):
+        return [operation for operation, rel in list(operation_links.items()) if rel in self.links]
+
+    def self_url(self, remove=False):
+        if not self.keys:
+            return self.rng.choice(self.urls["self"])
+        index = self.rng.randrange(len(self.keys))
+        key = self.keys[index]
+        if remove:
+            # the instance is about to be deleted
+            self.keys[index] = self.keys[-1]
+            self.keys.pop()
+        # keys with / ? or % would give another route, quote them like UrlGenerator
+        return self.templates["self"] % {self.key_name:quote(str(key), safe="")}
+
+    def request(self, operation):
+        """Returns (method, url, json body or None) for the operation"""
+        if operation == "get":
+            return ("GET", self.self_url(), None)
+        if operation == "delete":
+            return ("DELETE", self.self_url(remove=True), None)
+        if operation == "instances":
+            return ("GET", self.links["instances"], None)
+        body = self.generate()
+        if operation == "create":
+            return ("POST", self.links["create"], body)
+        body.pop(self.key_name, None)
+        return ("PUT", self.self_url(), body)
+
+    def response(self, operation, status, body):
+        if operation == "create" and status == 201:
+            self.keys.append(json.loads(body)[self.key_name])
+
+
+class LoadTest:
+    """Sends a weighted mix of requests to the resources of schemas, from
+    concurrency clients at most and rate requests per second at most,
+    for duration seconds or count requests.
+    The connections are pooled by an httpx.AsyncClient, a client can be
+    given instead, for example one using an ASGI transport."""
+
+    def __init__(self, base_url, schemas, schemas_store=None, weights=None, concurrency=10,
+                 rate=None, duration=10.0, count=None, seed=None, client=None, timeout=10.0):
+        if client is None and httpx is None:
+            raise Exception("httpx is required to run load tests")
+        self.base_url = base_url.rstrip("/")
+        self.concurrency = concurrency
+        self.rate = rate
+        self.duration = duration
+        self.count = count
+        self.client = client
+        self.timeout = timeout
+        self.rng = random.Random(seed)
+
+        if schemas_store is None:
+            schemas_store = SchemasStore()
+        for schema in schemas:
+            if isinstance(schema, dict):
+                schemas_store.add_schema(schema)
+        data_generator = DataGenerator(schemas_store, seed=seed)
+        url_generator = UrlGenerator(seed=seed)
+
+        # weighted (target, operation) choices
+        weights = dict(default_weights, **(weights or {}))
+        self.targets = []
+        self.mix = []
+        self.mix_weights = []
+        for schema in schemas:
+            name = schema["name"] if isinstance(schema, dict) else schema
+            target = Target(schemas_store.resolved(name), data_generator, url_generator, self.rng)
+            self.targets.append(target)
+            for operation in target.operations():
+                if weights.get(operation, 0) > 0:
+                    self.mix.append((target, operation))
+                    self.mix_weights.append(weights[operation])
+        if not self.mix:
+            raise Exception("No operation to run on the schemas")
+
+    def run(self):
+        """Runs the load test, returns the report"""
+        return asyncio.run(self.run_async())
+
+    async def run_async(self):
+        # "name operation" -> latencies, "name operation" -> status -> count
+        self.latencies = dict(("%s %s" % (target.name, operation), []) for target, operation in self.mix)
+        self.statuses = dict((name, {}) for name in self.latencies)
+        self.errors = 0
+        self.sent = 0
+        self.start = time.perf_counter()
+
+        client = self.client
+        if client is None:
+            client = httpx.AsyncClient(base_url=self.base_url, timeout=self.timeout,
+                                       limits=httpx.Limits(max_connections=self.concurrency,
+                                                           max_keepalive_connections=self.concurrency))
+        try:
+            await asyncio.gather(*[self.worker(client) for x in range(self.concurrency)])
+        finally:
+            if client is not self.client:
+                await client.aclose()
+        self.elapsed = time.perf_counter() - self.start
+        return self.report()
+
+    def next_request(self):
+        """Returns the time to send the next request at, None when done"""
+        if self.count is not None and self.sent >= self.count:
+            return None
+        if self.duration is not None and time.perf_counter() - self.start >= self.duration:
+            return None
+        index = self.sent
+        self.sent += 1
+        return self.start + index / self.rate if self.rate else 0
+
+    async def worker(self, client):
+        while True:
+            send_at = self.next_request()
+            if send_at is None:
+                return
+            delay = send_at - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            target, operation = self.rng.choices(self.mix, self.mix_weights)[0]
+            method, url, body = target.request(operation)
+            name = "%s %s" % (target.name, operation)
+            started = time.perf_counter()
+            try:
+                response = await client.request(method, self.base_url + url, json=body)
+            except Exception:
+                self.errors += 1
+                continue
+            self.latencies[name].append(time.perf_counter() - started)
+            self.statuses[name][response.status_code] = self.statuses[name].get(response.status_code, 0) + 1
+            target.response(operation, response.status_code, response.content)
+
+    def report(self):
+        """Returns the throughput and the latencies percentiles, overall and by operation"""
+        def stats(latencies):
+            latencies = sorted(latencies)
+            return {
+                "requests":len(latencies),
+                "p50":percentile(latencies, 0.5),
+                "p90":percentile(latencies, 0.9),
+                "p99":percentile(latencies, 0.99),
+                "max":latencies[-1] if latencies else None,
+            }
+
+        report = stats([latency for latencies in list(self.latencies.values()) for latency in latencies])
+        report.update({
+            "elapsed":self.elapsed,
+            "throughput":report["requests"] / self.elapsed if self.elapsed else 0,
+            "errors":self.errors,
+            "operations":{},
+        })
+        for name, latencies in list(self.latencies.items()):
+            report["operations"][name] = stats(latencies)
+            report["operations"][name]["statuses"] = dict(
+                (str(status), count) for status, count in sorted(self.statuses[name].items()))
+        return report
+
+
+def format_report(report):
+    ms = lambda value: "%8.2f" % (value * 1000) if value is not None else "       -"
+    lines = [
+        "%d requests in %.2fs, %.1f requests/s, %d errors" % (
+            report["requests"], report["elapsed"], report["throughput"], report["errors"]),
+        "%-30s %8s %8s %8s %8s %8s  %s" % ("latency (ms)", "requests", "p50", "p90", "p99", "max", "statuses"),
+    ]
+    rows = sorted(report["operations"].items()) + [("all", report)]
+    for name, stats in rows:
+        lines.append("%-30s %8d %s %s %s %s  %s" % (
+            name, stats["requests"], ms(stats["p50"]), ms(stats["p90"]), ms(stats["p99"]), ms(stats["max"]),
+            " ".join("%s:%d" % item for item in list(stats.get("statuses", {}).items()))))
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser(usage="usage: %prog --url http://host:port --schema name [--schema name...]")
+    parser.add_option('-u', '--url', help='Base url of the api', default="http://0.0.0.0:5000", dest='url', action='store')
+    parser.add_option('-s', '--schema', help='Name of a schema to test, can be repeated', default=[], dest='schemas', action='append')
+    parser.add_option('-f', '--folder', help='Folder to load the schemas from',
+                      default=os.path.join(os.path.dirname(__file__), "data/schemas"), dest='folder', action='store')
+    parser.add_option('-c', '--concurrency', help='Number of concurrent clients', default=10, type='int', dest='concurrency', action='store')
+    parser.add_option('-r', '--rate', help='Target number of requests per second, as fast as possible if omitted',
+                      type='float', dest='rate', action='store')
+    parser.add_option('-d', '--duration', help='Duration of the test in seconds', default=10.0, type='float', dest='duration', action='store')
+    parser.add_option('-n', '--count', help='Number of requests to send, stops at the duration if omitted',
+                      type='int', dest='count', action='store')
+    parser.add_option('-w', '--weight', help='Weight of an operation as operation=weight (%s), can be repeated' % (
+        ", ".join(sorted(default_weights))), default=[], dest='weights', action='append')
+    parser.add_option('--seed', help='Seed of the generated requests', type='int', dest='seed', action='store')
+    parser.add_option('-o', '--out', help='File to write the report to as json', dest='out', action='store')
+    (opts, args) = parser.parse_args()
+
+    if not opts.schemas:
+        parser.error("--schema is required")
+
+    weights = {}
+    for weight in opts.weights:
+        operation, _, value = weight.partition("=")
+        if operation not in default_weights or not value.isdigit():
+            parser.error("invalid weight %s" % weight)
+        weights[operation] = int(value)
+
+    store = SchemasStore()
+    store.load_folder(opts.folder)
+    load_test = LoadTest(opts.url, opts.schemas, store, weights, opts.concurrency, opts.rate,
+                         opts.duration if opts.count is None else None, opts.count, opts.seed)
+    report = load_test.run()
+    print(format_report(report))
+    if opts.out:
+        with open(opts.out, "w") as out:
+            json.dump(report, out, indent=2)
@@ -1,4 +1,12 @@
+import copy
+import hashlib
+import importlib.util
 import json
+import keyword
+import operator
+import os
+import re
+import weakref
 from . import utils
 
 from .validation import generate_validator_for_property
@@ -74,20 +82,202 @@ class Model(object):
         return {key: getattr(self, key) for key in list(getattr(self, "__properties").keys())}
 
 
+class ValidatedProperty(object):
+    """Descriptor validating a property before storing it in its slot"""
+    __slots__ = ("name", "slot", "validator")
+
+    def __init__(self, name, slot, validator):
+        self.name = name
+        self.slot = slot
+        self.validator = validator
+
+    def __get__(self, obj, cls=None):
+        if obj is None:
+            return self
+        return self.slot.__get__(obj, cls)
+
+    def __set__(self, obj, value):
+        if self.validator:
+            self.validator(obj, self.name, value)
+        self.slot.__set__(obj, value)
+
+
+class CompactModel(object):
+    """Base of the models generated with compact=True.
+    Values are stored in __slots__ instead of a __dict__, each property
+    is a ValidatedProperty descriptor. Setting an unknown attribute raises
+    an AttributeError, UnknownPropertyError is only raised by __init__."""
+    __slots__ = ()
+
+    def __init__(self, **kwargs):
+        cls = self.__class__
+        properties = getattr(cls, "__properties")
+
+        # set the attributes
+        for key, value in list(kwargs.items()):
+            if key not in properties:
+                raise UnknownPropertyError(cls.__name__, key)
+            setattr(self, key, value)
+
+        # the other properties get their default value
+        for slot, default in getattr(cls, "__defaults"):
+            try:
+                slot.__get__(self, cls)
+            except AttributeError:
+                slot.__set__(self, default)
+
+        # check that all the required args are present
+        for required_prop in getattr(cls, "__required"):
+            if required_prop not in kwargs:
+                raise MissingRequiredPropertyError(cls.__name__, required_prop)
+
+    def __repr__(self):
+        properties = getattr(self, "__properties")
+        return "<%s %s>" % (self.__class__.__name__,
+                            ','.join(["%s=%s" % (attr_name, getattr(self, attr_name))
+                                      for attr_name in sorted(properties.keys())]))
+
+    def to_dict(self):
+        return dict(zip(getattr(self, "__names"), getattr(self, "__values")(self)))
+
+
+# module name -> methods of the models generated with codegen
+generated_modules = {}
+
+
 class ModelGenerator:
 
-    def __init__(self):
-        pass
+    def __init__(self, schemas_store=None, cache_dir=None):
+        self.schemas_store = schemas_store
+        # where the sources of the models generated with codegen are cached
+        self.cache_dir = cache_dir
+        self.listened_store = None
+        # schema name -> weak references to the models generated from it
+        self.generated = {}
+
+    def track(self, name, model):
+        """Keeps a weak reference to a model generated from a schema of the
+        store, its validators are updated when the store reloads the schema"""
+        if not self.schemas_store:
+            return
+        if self.listened_store is not self.schemas_store:
+            self.schemas_store.add_listener(self.schemas_changed)
+            self.listened_store = self.schemas_store
+        refs = [ref for ref in self.generated.get(name, []) if ref() is not None]
+        refs.append(weakref.ref(model))
+        self.generated[name] = refs
+
+    def schemas_changed(self, names):
+        """Updates the validators of the models generated from the changed
+        schemas. The properties, keys and links of a model can't change,
+        generate a new model when they do."""
+        for name in names & set(self.generated):
+            schema = self.schemas_store.resolved(name)
+            refs = [ref for ref in self.generated[name] if ref() is not None]
+            self.generated[name] = refs
+            if not schema:
+                # removed from the store, keep the last validators
+                continue
+            for ref in refs:
+                model = ref()
+                if model is not None:
+                    self.update_validators(model, schema.get("properties", {}))
+
+    def update_validators(self, model, properties):
+        """Replaces the validators of the properties of a generated model by
+        the ones of properties, the properties missing from it are kept"""
+        validators = getattr(model, "__validators", None)
+        for property_name in list(getattr(model, "__properties")):
+            if property_name not in properties:
+                continue
+            validator = generate_validator_for_property(property_name, properties[property_name])
+            descriptor = model.__dict__.get(property_name)
+            if isinstance(descriptor, ValidatedProperty):
+                descriptor.validator = validator
+            elif validator:
+                validators[property_name] = validator
+            else:
+                validators.pop(property_name, None)
+
+    def get_schema(self, schema):
+        """Returns a copy of the resolved schema from the store if given a name"""
+        if isinstance(schema, str):
+            if not self.schemas_store or not self.schemas_store.resolved(schema):
+                raise Exception("Unknown schema '%s'" % schema)
+            # generate adds the implicit key to the properties
+            return copy.deepcopy(self.schemas_store.resolved(schema))
+        return schema
+
+    def generate(self, schema, codegen=False):
+        """Returns the attributes of a model class for the schema.
+        With codegen=True the methods are generated as python source
+        (see generate_source) instead of generic lambdas."""
+        schema = self.get_schema(schema)
+        properties = schema.get("properties", {})
+
+        # find the primary key from the "self" link
+        # or create one with a new column
+        try:
+            key_name = utils.get_resource_key(schema)
+        except Exception:
+            key_name = "id"
+            while key_name in list(properties.keys()):
+                key_name = '_' + key_name
+
+        # add a new property for the key if it doesn't exist
+        implicit_key = False
+        if key_name not in properties:
+            properties[key_name] = {"type": "integer", "minimum": 0}
+            implicit_key = True
+
+        # process the links section
+        rel_links = {"root": (
+            "/", "/")}  # provide default root if none is given
+        for schema_link in schema.get("links", []):
+            rel = schema_link.get("rel", None)
+            if not rel:
+                continue
+            href = schema_link.get("href", "")
+            rel_links[rel] = (href, utils.url_to_template(href))
+
+        # store the links
+        # - the json-schema format with root in links[<rel>]
+        # - the templates to generate actual links with <rel>_link
+        links = {}
+        templates = {}
+        root = links["root"] = rel_links["root"]
+        for rel, (href, template_href) in list(rel_links.items()):
+            if rel != "root":
+                (json_base, template_base) = root
+                if href:
+                    json_base = json_base.rstrip("/") + "/" + href
+                    template_base = template_base.rstrip("/") + "/" + template_href
+                links[rel] = json_base
+                templates[rel] = template_base
+
+        attribs = {
+            "properties": properties,
+            "implicit_key": implicit_key,
+            "key_name": key_name,
+            "schema": schema,
+            "links": links,
+        }
+        if codegen:
+            attribs.update(self.generated_methods(schema["name"], properties, key_name,
+                                                  implicit_key, templates))
+        else:
+            attribs.update(self.generic_methods(schema["name"], properties, key_name,
+                                                implicit_key, templates))
+        return attribs
 
-    def generate(self, schema):
+    def generic_methods(self, name, properties, key_name, implicit_key, templates):
+        names = frozenset(properties)
 
         def init(obj, **kwargs):
             # set the attributes
             for key, value in list(kwargs.items()):
                 if key not in properties:
-                    raise UnknownPropertyError(schema["name"], key)
-                    if key == key_name and implicit_key:
-                        raise ReadOnlyPropertyError(schema["name"], key)
+                    raise UnknownPropertyError(name, key)
 
                 setattr(obj, key, value)
 
@@ -96,91 +286,211 @@ class ModelGenerator:
                                   if prop_schema.get("required", False)]:
                 if required_prop not in list(kwargs.keys()):
                     raise MissingRequiredPropertyError(
-                        schema["name"], required_prop)
+                        name, required_prop)
 
-        properties = schema.get("properties", {})
-        implicit_key = False
-        attribs = {
+        methods = {
             "__init__": init,
             "__repr__": lambda obj:
             "<%s %s>" % (obj.__class__.__name__,
                          ','.join(["%s=%s" % (attr_name, getattr(obj, attr_name))
                                    for attr_name in list(properties.keys())])),
-            "properties": properties,
             "properties_values": lambda obj:
-            dict((
-                k, v) for k, v in obj.__dict__.items(
-                ) if k in list(properties.keys())),
+            dict((k, v) for k, v in obj.__dict__.items() if k in names),
             "updatable": lambda obj, key:
             key in list(properties.keys()) and key != obj.key_name,
             "writable": lambda obj, key:
-            key in list(properties.keys()) and key != obj.key_name or not obj[
-                "implicit_key"],
-            "implicit_key": implicit_key,
+            key in list(properties.keys()) and (key != obj.key_name or not obj.implicit_key),
             "key_value": lambda obj:
             getattr(obj, obj.key_name),
             "key_dict": lambda obj:
             {obj.key_name: obj.key_value()},
-            "schema": schema,
-            "links": {},
         }
-
-        # process the links section
-        rel_links = {"root": (
-            "/", "/")}  # provide default root if none is given
-        for schema_link in schema.get("links", []):
-            rel = schema_link.get("rel", None)
-            if not rel:
-                continue
-                href = schema_link.get("href", "")
-                rel_links[rel] = (href, utils.url_to_template(href))
-
-        # store the links
-        # - the json-schema format with root in links[<rel>]
-        # - add helper lambdas to generate actual links under link_<rel>
-        root = attribs["links"]["root"] = rel_links["root"]
-        for rel, (href, template_href) in list(rel_links.items()):
-            if rel != "root":
-                (json_base, template_base) = root
-                if href:
-                    json_base += "/" + href
-                    template_base += "/" + template_href
-                    attribs["links"][rel] = json_base
-                    attribs["%s_link" % rel] = lambda obj, template_base=template_base: template_base % obj.properties_values()
-
-        # find the primary key from the "self" link
-        # or create one with a new column
-        try:
-            key_name = utils.get_resource_key(schema)
-        except Exception:
-            key_name = "id"
-            while key_name in list(properties.keys()):
-                key_name = '_' + key_name
-
-        # add a new property for the key if it doesn't exist
-        if key_name not in properties:
-            properties[key_name] = {"type": "integer", "minimum": 0}
-            implicit_key = True
-
-        attribs["key_name"] = key_name
-        return attribs
-
-    def generate_model(self, schema):
+        for rel, template in list(templates.items()):
+            methods["%s_link" % rel] = lambda obj, template=template: template % obj.properties_values()
+        return methods
+
+    def generated_methods(self, name, properties, key_name, implicit_key, templates):
+        """Returns the methods generated from the source of the model.
+        The compiled code is cached in memory, and in cache_dir as a module
+        if set so later runs import it instead of compiling it again."""
+        source = self.generate_source(name, properties, key_name, implicit_key, templates)
+        digest = hashlib.sha256(source.encode("utf-8")).hexdigest()[:16]
+        module_name = "apitools_model_%s_%s" % (re.sub(r"\W", "_", name), digest)
+
+        if module_name not in generated_modules:
+            if self.cache_dir:
+                path = os.path.join(self.cache_dir, module_name + ".py")
+                if not os.path.exists(path):
+                    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+                    with open(tmp_path, "w") as module_file:
+                        module_file.write(source)
+                    os.replace(tmp_path, path)
+                spec = importlib.util.spec_from_file_location(module_name, path)
+                module = importlib.util.module_from_spec(spec)
+                spec.loader.exec_module(module)
+                namespace = module.__dict__
+            else:
+                namespace = {}
+                exec(compile(source, "<%s>" % module_name, "exec"), namespace)
+            generated_modules[module_name] = namespace["methods"]
+        return dict(generated_modules[module_name])
+
+    def generate_source(self, name, properties, key_name, implicit_key, templates):
+        """Returns the python source of the methods of the model, with
+        constant sets for the membership tests and one statement per
+        property instead of loops"""
+        names = list(properties.keys())
+        required = [prop_name for prop_name in names
+                    if properties[prop_name].get("required", False)]
+        writable = [prop_name for prop_name in names
+                    if prop_name != key_name or not implicit_key]
+
+        def attr(prop_name):
+            if re.match(r"^[a-zA-Z_][a-zA-Z0-9_]*$", prop_name) and not keyword.iskeyword(prop_name):
+                return "obj.%s" % prop_name
+            return "getattr(obj, %r)" % prop_name
+
+        lines = [
+            "from apitools.modelgenerator import UnknownPropertyError, MissingRequiredPropertyError",
+            "",
+            "NAME = %r" % name,
+            "PROPERTIES = frozenset(%r)" % names,
+            "UPDATABLE = frozenset(%r)" % [prop_name for prop_name in names if prop_name != key_name],
+            "WRITABLE = frozenset(%r)" % writable,
+            "",
+            "def __init__(obj, **kwargs):",
+            "    for key in kwargs:",
+            "        if key not in PROPERTIES:",
+            "            raise UnknownPropertyError(NAME, key)",
+        ]
+        for prop_name in names:
+            lines.append("    if %r in kwargs:" % prop_name)
+            if attr(prop_name).startswith("obj."):
+                lines.append("        %s = kwargs[%r]" % (attr(prop_name), prop_name))
+            else:
+                lines.append("        setattr(obj, %r, kwargs[%r])" % (prop_name, prop_name))
+        for prop_name in required:
+            lines.append("    if %r not in kwargs:" % prop_name)
+            lines.append("        raise MissingRequiredPropertyError(NAME, %r)" % prop_name)
+
+        lines += [
+            "",
+            "def __repr__(obj):",
+            "    return %r %% (obj.__class__.__name__, %s)" % (
+                "<%%s %s>" % ",".join("%s=%%s" % prop_name.replace("%", "%%") for prop_name in names),
+                "".join("%s, " % attr(prop_name) for prop_name in names)),
+            "",
+            "def properties_values(obj):",
+            "    values = obj.__dict__",
+            "    res = {}",
+        ]
+        for prop_name in names:
+            lines.append("    if %r in values:" % prop_name)
+            lines.append("        res[%r] = values[%r]" % (prop_name, prop_name))
+        lines += [
+            "    return res",
+            "",
+            "def updatable(obj, key):",
+            "    return key in UPDATABLE",
+            "",
+            "def writable(obj, key):",
+            "    return key in WRITABLE",
+            "",
+            "def key_value(obj):",
+            "    return %s" % attr(key_name),
+            "",
+            "def key_dict(obj):",
+            "    return {%r: %s}" % (key_name, attr(key_name)),
+            "",
+            "methods = {",
+            "    '__init__': __init__,",
+            "    '__repr__': __repr__,",
+            "    'properties_values': properties_values,",
+            "    'updatable': updatable,",
+            "    'writable': writable,",
+            "    'key_value': key_value,",
+            "    'key_dict': key_dict,",
+            "}",
+        ]
+
+        for rel, template in sorted(templates.items()):
+            fn_name = "link_%s" % re.sub(r"\W", "_", rel)
+            args = re.findall(r"%\(([a-zA-Z_]+)\)s", template)
+            lines += [
+                "",
+                "def %s(obj):" % fn_name,
+                "    return %r %% (%s)" % (re.sub(r"%\([a-zA-Z_]+\)s", "%s", template),
+                                          "".join("%s, " % attr(arg) for arg in args)),
+                "",
+                "methods[%r] = %s" % ("%s_link" % rel, fn_name),
+            ]
+        return "\n".join(lines) + "\n"
+
+    def generate_model(self, schema, compact=False):
+        """Generates a Model class for the schema, or a CompactModel class
+        using __slots__ if compact is True. Models generated from the name of
+        a schema of the store follow the changes of its validators."""
+        name = schema if isinstance(schema, str) else None
+        schema = self.get_schema(schema)
+        if compact:
+            model = self.generate_compact_model(schema)
+        else:
+            properties = schema.get("properties", {})
+            attribs = {
+                "__validators": {},
+                "__properties": properties,
+            }
+
+            # add columns and validators from the schema properties
+            for property_name, property_schema in list(properties.items()):
+                attribs[property_name] = property_schema.get("default", None)
+                validator = generate_validator_for_property(
+                    property_name, property_schema)
+                if validator:
+                    attribs["__validators"][property_name] = validator
+
+            model = type(str(schema["name"]), (Model,), attribs)
+
+        if name:
+            self.track(name, model)
+        return model
+
+    def generate_compact_model(self, schema):
         properties = schema.get("properties", {})
+        names = tuple(properties.keys())
+        slot_names = tuple("_slot_%s" % name for name in names)
+
         attribs = {
-            "__validators": {},
+            "__slots__": slot_names,
             "__properties": properties,
+            "__names": names,
+            "__required": tuple(name for name in names
+                                if properties[name].get("required", False)),
         }
 
-        # add columns and validators from the schema properties
-        for property_name, property_schema in list(properties.items()):
-            attribs[property_name] = property_schema.get("default", None)
-            validator = generate_validator_for_property(
-                property_name, property_schema)
-            if validator:
-                attribs["__validators"][property_name] = validator
-
-        return type(str(schema["name"]), (Model,), attribs)
+        # read all the slots at once in to_dict
+        if len(slot_names) == 1:
+            getter = operator.attrgetter(slot_names[0])
+            attribs["__values"] = lambda obj: (getter(obj),)
+        elif slot_names:
+            attribs["__values"] = operator.attrgetter(*slot_names)
+        else:
+            attribs["__values"] = lambda obj: ()
+
+        model = type(str(schema["name"]), (CompactModel,), attribs)
+
+        # replace the properties by descriptors validating the values
+        # before storing them in the slots
+        defaults = []
+        for property_name, slot_name in zip(names, slot_names):
+            property_schema = properties[property_name]
+            slot = model.__dict__[slot_name]
+            validator = generate_validator_for_property(property_name, property_schema)
+            setattr(model, property_name, ValidatedProperty(property_name, slot, validator))
+            defaults.append((slot, property_schema.get("default", None)))
+        setattr(model, "__defaults", tuple(defaults))
+
+        return model
 
 if __name__ == "__main__":
     generator = ModelGenerator()
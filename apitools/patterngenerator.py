@@ -0,0 +1,165 @@
+import functools
+import re
+import string
+
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+
+# characters used for ".", negated sets and negated categories
+printable = string.printable
+
+categories = {
+    sre_parse.CATEGORY_DIGIT: string.digits,
+    sre_parse.CATEGORY_SPACE: string.whitespace,
+    sre_parse.CATEGORY_WORD: string.ascii_letters + string.digits + "_",
+}
+categories.update({
+    sre_parse.CATEGORY_NOT_DIGIT: "".join(c for c in printable if c not in string.digits),
+    sre_parse.CATEGORY_NOT_SPACE: "".join(c for c in printable if c not in string.whitespace),
+    sre_parse.CATEGORY_NOT_WORD: "".join(c for c in printable
+                                         if c not in categories[sre_parse.CATEGORY_WORD]),
+})
+
+repeat_ops = [sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT]
+if hasattr(sre_parse, "POSSESSIVE_REPEAT"):
+    repeat_ops.append(sre_parse.POSSESSIVE_REPEAT)
+
+
+class PatternGenerator:
+    """Generates strings matching a regular expression.
+    The pattern is parsed once into a tree of functions, use
+    compile_pattern to get a cached instance for a pattern."""
+
+    # maximum number of repetitions for * and +
+    star_plus_limit = 100
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.regex = re.compile(pattern)
+        self.fn = self.compile_subpattern(sre_parse.parse(pattern))
+
+    def generate(self, rng):
+        """Returns a string matching the pattern using the random.Random rng"""
+        return self.fn(rng, {})
+
+    def generate_many(self, rng, count):
+        fn = self.fn
+        return [fn(rng, {}) for x in range(count)]
+
+    def compile_subpattern(self, subpattern):
+        fns = [self.compile_node(op, av) for (op, av) in subpattern]
+        if len(fns) == 1:
+            return fns[0]
+        return lambda rng, groups: "".join([fn(rng, groups) for fn in fns])
+
+    def compile_node(self, op, av):
+        if op == sre_parse.LITERAL:
+            char = chr(av)
+            return lambda rng, groups: char
+
+        if op in (sre_parse.ANY, sre_parse.NOT_LITERAL, sre_parse.IN, sre_parse.CATEGORY):
+            chars = self.charset(op, av)
+            if not chars:
+                raise Exception("Can't generate a character for %r" % self.pattern)
+            return lambda rng, groups: rng.choice(chars)
+
+        if op in repeat_ops:
+            return self.compile_repeat(*av)
+
+        if op == sre_parse.BRANCH:
+            branches = [self.compile_subpattern(branch) for branch in av[1]]
+            return lambda rng, groups: rng.choice(branches)(rng, groups)
+
+        if op == sre_parse.SUBPATTERN:
+            group = av[0]
+            fn = self.compile_subpattern(av[-1])
+            if group is None:
+                return fn
+
+            def capture(rng, groups):
+                value = groups[group] = fn(rng, groups)
+                return value
+            return capture
+
+        if op == getattr(sre_parse, "ATOMIC_GROUP", None):
+            return self.compile_subpattern(av)
+
+        if op == sre_parse.GROUPREF:
+            return lambda rng, groups: groups.get(av, "")
+
+        if op == sre_parse.GROUPREF_EXISTS:
+            group, yes, no = av
+            yes_fn = self.compile_subpattern(yes)
+            no_fn = self.compile_subpattern(no) if no else (lambda rng, groups: "")
+            return lambda rng, groups: (yes_fn if group in groups else no_fn)(rng, groups)
+
+        if op in (sre_parse.AT, sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+            # anchors and lookarounds don't produce anything
+            return lambda rng, groups: ""
+
+        raise Exception("Unsupported regular expression construct %s in %r" % (op, self.pattern))
+
+    def compile_repeat(self, min_repeat, max_repeat, subpattern):
+        if max_repeat == sre_parse.MAXREPEAT:
+            max_repeat = min_repeat + self.star_plus_limit
+
+        # single characters are drawn all at once
+        if len(subpattern) == 1:
+            op, av = subpattern[0]
+            if op in (sre_parse.ANY, sre_parse.NOT_LITERAL, sre_parse.IN,
+                      sre_parse.CATEGORY, sre_parse.LITERAL):
+                chars = chr(av) if op == sre_parse.LITERAL else self.charset(op, av)
+                if not chars:
+                    raise Exception("Can't generate a character for %r" % self.pattern)
+                return lambda rng, groups: "".join(
+                    rng.choices(chars, k=rng.randint(min_repeat, max_repeat)))
+
+        fn = self.compile_subpattern(subpattern)
+        return lambda rng, groups: "".join([
+            fn(rng, groups) for x in range(rng.randint(min_repeat, max_repeat))])
+
+    def charset(self, op, av):
+        """Returns the characters matched by a single character node"""
+        if op == sre_parse.ANY:
+            return printable.replace("\n", "")
+        if op == sre_parse.NOT_LITERAL:
+            return printable.replace(chr(av), "")
+        if op == sre_parse.CATEGORY:
+            return categories[av]
+
+        chars = []
+        negate = False
+        for item_op, item_av in av:
+            if item_op == sre_parse.NEGATE:
+                negate = True
+            elif item_op == sre_parse.LITERAL:
+                chars.append(chr(item_av))
+            elif item_op == sre_parse.RANGE:
+                chars.extend(chr(c) for c in range(item_av[0], item_av[1] + 1))
+            elif item_op == sre_parse.CATEGORY:
+                chars.extend(categories[item_av])
+            else:
+                raise Exception("Unsupported set item %s in %r" % (item_op, self.pattern))
+
+        if negate:
+            return "".join(c for c in printable if c not in chars)
+        # keep the order to stay deterministic for a given seed
+        return "".join(sorted(set(chars)))
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_pattern(pattern):
+    """Returns the PatternGenerator for pattern, parsed once and cached"""
+    return PatternGenerator(pattern)
+
+
+if __name__ == "__main__":
+    import random
+
+    rng = random.Random()
+    for pattern in ["^\\d{12}(\\d|X)$", "0[0-9]{10}", "^[a-zA-Z]{10}[0-5]{,7}$", "(a|b)c\\1[^a-z]+"]:
+        generator = compile_pattern(pattern)
+        print(pattern, generator.generate_many(rng, 3))
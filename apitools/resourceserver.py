@@ -1,6 +1,8 @@
-from flask import Flask, request, abort, jsonify
-from sqlalchemy import exc
-from flask.ext.sqlalchemy import SQLAlchemy, orm
+from flask import Flask, Response, request, abort, jsonify, stream_with_context
+import sqlalchemy
+from sqlalchemy import exc, insert
+from sqlalchemy.orm import exc as orm_exc
+from flask_sqlalchemy import SQLAlchemy
 
 import json
 import re
@@ -9,22 +11,51 @@ import sys
 from .flasksqlalchemymodelgenerator import FlaskSQLAlchemyModelGenerator
 from .modelgenerator import UnknownPropertyError, MissingRequiredPropertyError, ReadOnlyPropertyError
 from .validation import ValidationError
+from .serializers import get_serializer
 from . import utils
 
+# SQLAlchemy 2 inserts many rows per statement and still returns their generated keys
+batched_returning = int(sqlalchemy.__version__.split(".")[0]) >= 2
+
+def conditional_response(body, etag):
+    """Returns the json body, or 304 if the client already has this version"""
+    headers = {"ETag":'"%s"' % etag}
+    if etag in request.if_none_match:
+        return ("", 304, headers)
+    headers["Content-Type"] = "application/json"
+    return (body, 200, headers)
+
 class ResourceServer:
 
-    def __init__(self, name=__name__, host="0.0.0.0", port=5000, database_uri='sqlite:////tmp/test.db'):
+    def __init__(self, name=__name__, host="0.0.0.0", port=5000, database_uri='sqlite:////tmp/test.db',
+                 bulk_batch_size=1000, stream_chunk_size=1000, cache_size=1024, serializer=None,
+                 schemas_store=None):
         # start flask-sqlalchemy
         self.app = Flask(name)
         self.app.config['SQLALCHEMY_DATABASE_URI'] = database_uri
         self.db = SQLAlchemy(self.app)
 
-        self.model_generator = FlaskSQLAlchemyModelGenerator()
+        # the resources added by name follow the validators of the store
+        self.model_generator = FlaskSQLAlchemyModelGenerator(schemas_store)
 
         # store these here to be able to generate links
         self.host = host
         self.port = port
 
+        # number of rows inserted per statement by bulk creates
+        self.bulk_batch_size = bulk_batch_size
+
+        # number of rows fetched and sent at once by streamed listings
+        self.stream_chunk_size = stream_chunk_size
+
+        # lru of the serialized instances, 0 disables it
+        self.response_cache = utils.ResponseCache(cache_size)
+
+        # serializer instance or name, see serializers.get_serializer
+        if serializer is None or isinstance(serializer, str):
+            serializer = get_serializer(serializer)
+        self.serializer = serializer
+
     def run(self,**kwargs):
         """Shortcut to start the server"""
         kwargs["host"] = self.host
@@ -36,24 +67,64 @@ class ResourceServer:
         self.db.session.add(resource)
         self.db.session.commit()
 
+    def add_all(self, model, resources):
+        """Shortcut to insert many instances of model in a single transaction,
+        bulk_batch_size rows per statement. The keys generated by the database
+        are set on the instances."""
+        implicit_key = model.implicit_key
+        key_column = getattr(model, model.key_name)
+        try:
+            for start in range(0, len(resources), self.bulk_batch_size):
+                batch = resources[start:start+self.bulk_batch_size]
+                mappings = [resource.properties_values() for resource in batch]
+                if implicit_key and batched_returning:
+                    # implicit keys are autoincremented in the order of the rows, sorting them is
+                    # enough to match them, sort_by_parameter_order would be one statement per row in sqlite
+                    keys = self.db.session.execute(insert(model).returning(key_column), mappings).scalars().all()
+                    for resource, key in zip(batch, sorted(keys)):
+                        setattr(resource, model.key_name, key)
+                else:
+                    # before SQLAlchemy 2 fetching the generated keys needs one statement per row
+                    self.db.session.bulk_insert_mappings(model, mappings, return_defaults=implicit_key)
+                    if implicit_key:
+                        for resource, mapping in zip(batch, mappings):
+                            setattr(resource, model.key_name, mapping[model.key_name])
+            self.db.session.commit()
+        except:
+            self.db.session.rollback()
+            raise
+
     def delete(self, resource):
         """Shortcut to remove the resource instance from the database"""
+        # the instance is expired after the commit, get the key before
+        key = resource.key_value()
         self.db.session.delete(resource)
         self.db.session.commit()
+        self.response_cache.invalidate(resource.__class__.__name__, key)
 
-    def save(self):
-        """Shortcut to save a changes to the database"""
+    def save(self, resource=None):
+        """Shortcut to save a changes to the database, resource is the
+        instance changed if any, to remove it from the cache"""
+        key = resource.key_value() if resource is not None else None
         self.db.session.commit()
+        if resource is not None:
+            self.response_cache.invalidate(resource.__class__.__name__, key)
+
+    def cache_invalidate(self, resource):
+        """Removes an instance from the cache, to call when it's changed
+        without going through save or delete"""
+        self.response_cache.invalidate(resource.__class__.__name__, resource.key_value())
 
     def host_str(self):
         return "http://%s:%d"%(self.host, self.port)
 
     def add_resource(self, schema):
-        """Add the resource to the list of resources the server can handle"""
+        """Add the resource to the list of resources the server can handle,
+        schema can be the name of a schema of the server's schemas_store"""
 
         # generate and store the model
         model = self.model_generator.generate(self.db, schema)
-        setattr(self, schema["name"], model)
+        setattr(self, model.__name__, model)
 
         def add_route(fn, methods=["GET"]):
             # transform the link href into a flask route
@@ -66,30 +137,123 @@ class ResourceServer:
             ret.status_code = code
             return ret
 
+        # read the columns in the schema order and encode them without building dicts
+        key_column = getattr(model, model.key_name)
+        columns = list(model.properties.keys())
+        columns_encoder = lambda names: self.serializer.row_encoder(
+            names, [model.properties[name]["type"] for name in names])
+        encode = columns_encoder(columns)
+
+        def stream_instances(query, encode, ndjson):
+            # fetch and send the rows stream_chunk_size at a time
+            chunk = []
+            separator = "\n" if ndjson else ","
+            started = False
+            if not ndjson:
+                yield "["
+            for res in query.yield_per(self.stream_chunk_size):
+                chunk.append(encode(res))
+                if len(chunk) == self.stream_chunk_size:
+                    yield (separator if started else "") + separator.join(chunk)
+                    started = True
+                    chunk = []
+            if chunk:
+                yield (separator if started else "") + separator.join(chunk)
+            yield "\n" if ndjson else "]"
+
         # generate routes automatically for some of the links
         if "instances" in model.links:
-            # returns all the instances of the model
+            key_type = utils.property_types.get(model.properties[model.key_name]["type"], str)
+
+            # returns the instances of the model
+            # - paginated with limit and offset or after (the last key of the previous page)
+            # - streamed as a json array or ndjson with stream=json|ndjson
+            # - only with some properties with fields=<property>,<property>
+            # - filtered with <property>=<value>, <property>__min, <property>__max (numbers)
+            #   and <property>__prefix (strings)
             def r_instances(**kwargs):
-                return (json.dumps([res.properties_values() for res in model.query.all()]), 
-                        200,
-                        {"Content-Type":"application/json"})
+                query = model.query
+                try:
+                    limit = request.args.get("limit", None)
+                    limit = int(limit) if limit is not None else None
+                    offset = int(request.args.get("offset", 0))
+                    after = request.args.get("after", None)
+                    after = key_type(after) if after is not None else None
+                except ValueError as error:
+                    return input_error("Invalid pagination: %s"%error)
+
+                try:
+                    query = query.filter(*utils.filter_clauses(model, request.args))
+                except ValueError as error:
+                    return input_error("Invalid filter: %s"%error)
+
+                fields = request.args.get("fields", None)
+                if fields:
+                    fields = fields.split(",")
+                    for field in fields:
+                        if field not in model.properties:
+                            return input_error(UnknownPropertyError(model.__name__, field))
+                    row_encoder = columns_encoder(fields)
+                else:
+                    fields = columns
+                    row_encoder = encode
+                # only select the columns needed, with the key for the next link
+                query = query.with_entities(*[getattr(model, field) for field in fields + [model.key_name]])
+
+                if after is not None:
+                    query = query.filter(key_column > after)
+                if limit is not None or offset or after is not None:
+                    query = query.order_by(key_column)
+                if offset:
+                    query = query.offset(offset)
+                if limit is not None:
+                    query = query.limit(limit)
+
+                stream = request.args.get("stream", None)
+                if stream in ["json", "ndjson"]:
+                    return Response(stream_with_context(stream_instances(query, row_encoder, stream == "ndjson")),
+                                    mimetype="application/x-ndjson" if stream == "ndjson" else "application/json")
+
+                headers = {"Content-Type":"application/json"}
+                rows = query.all()
+                if limit and len(rows) == limit:
+                    headers["Link"] = '<%s%s?%s>; rel="next"' % (
+                        self.host_str(), model.links["instances"],
+                        utils.next_page_query(request.args, limit, rows[-1][-1]))
+                return ("[%s]" % ", ".join([row_encoder(row) for row in rows]), 200, headers)
             add_route(r_instances)
 
         if "self" in model.links:
-            # returns an instance of the object by key
+            # the schema doesn't change, serialize it once
+            schema_body = self.serializer.dumps(model.schema)
+            schema_etag = utils.make_etag(schema_body)
+
+            # returns an instance of the object by key, from the cache if possible
             # if used with OPTIONS, returns the json-schema
             def r_self(**kwargs):
                 if len(list(kwargs.keys())) != 1:
                     raise Exception("Self link with multiple arguments not supported")
+
+                if request.method == "OPTIONS":
+                    return conditional_response(schema_body, schema_etag)
+
+                if request.method == "GET":
+                    key = list(kwargs.values())[0]
+                    entry = self.response_cache.get(model.__name__, key)
+                    if entry is None:
+                        generation = self.response_cache.generation()
+                        row = model.query.filter(key_column == key).with_entities(
+                            *[getattr(model, column) for column in columns]).first()
+                        if not row:
+                            abort(404)
+                        entry = self.response_cache.put(model.__name__, key, encode(row), generation)
+                    return conditional_response(*entry)
+
                 res = model.query.filter_by(**kwargs).first()
                 if not res:
                     abort(404)
 
-                if request.method == "GET":
-                    return jsonify(res.properties_values())
-                elif request.method == "OPTIONS":
-                    return jsonify(res.schema)
-                elif request.method == "DELETE":
+                if request.method == "DELETE":
                     self.delete(res)
                     return ("",204)
                 elif request.method == "PUT":
@@ -99,7 +263,6 @@ class ResourceServer:
                         attribs = json.loads(request.data)
                     else:
                         return input_error("empty body")
-                    print(attribs)
                     for key, value in list(attribs.items()):
                         # don't let the update change readonly
                         # properties like the primary key
@@ -116,15 +279,50 @@ class ResourceServer:
                         except ValidationError as error:
                             return input_error(error)
 
-                    self.save()
+                    try:
+                        self.save(res)
+                    except orm_exc.StaleDataError:
+                        # deleted by another request since it was read
+                        self.db.session.rollback()
+                        abort(404)
                     return ("",200)
             add_route(r_self, ["GET", "OPTIONS", "DELETE","PUT"])
 
         if "create" in model.links:
-            # creates a new instance
+            def bulk_create(items):
+                # validate all the items first, the model checks the input in __init__
+                results = []
+                new_objs = []
+                for attribs in items:
+                    try:
+                        if not isinstance(attribs, dict):
+                            raise ValueError("not an object")
+                        new_objs.append(model(**attribs))
+                        results.append(None)
+                    except (ValueError, ValidationError, MissingRequiredPropertyError,
+                            UnknownPropertyError, ReadOnlyPropertyError) as error:
+                        results.append({"error":str(error)})
+
+                # insert the valid ones in one transaction
+                try:
+                    self.add_all(model, new_objs)
+                except exc.IntegrityError as error:
+                    return input_error(error, 409)
+
+                created = iter(new_objs)
+                results = [result or next(created).key_dict() for result in results]
+                return (self.serializer.dumps(results),
+                        201 if len(new_objs) == len(results) else 207,
+                        {"Content-Type":"application/json"})
+
+            # creates a new instance, or many if given a json array
+            # or newline-delimited json
             def r_create(**kwargs):
                 try:
-                    # this is ok as the model checks the input in __init__
+                    if request.mimetype in ["application/x-ndjson", "application/ndjson"]:
+                        return bulk_create([json.loads(line) for line in
+                                            request.get_data(as_text=True).splitlines()
+                                            if line.strip()])
 
                     if len(list(request.form.items())):
                         attribs = dict(list(request.form.items()))
@@ -132,6 +330,11 @@ class ResourceServer:
                         attribs = json.loads(request.data)
                     else:
                         return input_error("empty body")
+
+                    if isinstance(attribs, list):
+                        return bulk_create(attribs)
+
+                    # this is ok as the model checks the input in __init__
                     new_obj = model(**attribs)
 
                     # saves the object and return
@@ -149,7 +352,8 @@ class ResourceServer:
                     # should check for different types of failures and return 400
                     # can be duplicate on the primary key, or one of the
                     # constraints on the data failing
-                    input_error(error, 409)
+                    self.db.session.rollback()
+                    return input_error(error, 409)
                 except MissingRequiredPropertyError as error:
                     return input_error(error)
                 except UnknownPropertyError as error:
@@ -169,6 +373,7 @@ if __name__ == "__main__":
         server.add_resource(schema)
         print("Added %s"%schema["name"])
 
-    server.db.create_all()
+    with server.app.app_context():
+        server.db.create_all()
     server.run(debug=True)
     
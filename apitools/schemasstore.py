@@ -1,16 +1,148 @@
 import json
+import marshal
 import os
+import sys
+import threading
+import traceback
+import weakref
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+basic_types = ["string", "boolean", "number", "integer", "object", "array", "any", "null"]
+
+
+def type_reference(schema):
+    """Returns the name of the type referenced by a schema, None if it
+    doesn't reference a named type"""
+    type_name = schema.get("type")
+    if isinstance(type_name, str) and type_name not in basic_types:
+        return type_name
+    if type_name == "object" and "name" in schema and "properties" not in schema:
+        # reference to a named object, as in array items
+        return schema["name"]
+    return None
+
+
+def referenced_types(schema):
+    """Returns the names of the types used in a schema"""
+    names = set()
+    if not isinstance(schema, dict):
+        return names
+
+    if type_reference(schema):
+        names.add(type_reference(schema))
+
+    for prop_schema in list(schema.get("properties", {}).values()):
+        names.update(referenced_types(prop_schema))
+    if "items" in schema:
+        names.update(referenced_types(schema["items"]))
+    return names
+
+
+def strongly_connected(graph, names):
+    """Returns the groups of names depending on each other (cycles) in graph,
+    a name used by another one is always in an earlier group. The names
+    used outside of names are ignored."""
+    names_set = set(names)
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    groups = []
+
+    # iterative tarjan to support deep graphs
+    for root in names:
+        if root in index:
+            continue
+        work = [(root, iter(sorted(graph[root] & names_set)))]
+        index[root] = lowlink[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        while work:
+            name, refs = work[-1]
+            for ref in refs:
+                if ref not in index:
+                    index[ref] = lowlink[ref] = len(index)
+                    stack.append(ref)
+                    on_stack.add(ref)
+                    work.append((ref, iter(sorted(graph[ref] & names_set))))
+                    break
+                elif ref in on_stack:
+                    lowlink[name] = min(lowlink[name], index[ref])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[name])
+                if lowlink[name] == index[name]:
+                    group = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.remove(member)
+                        group.append(member)
+                        if member == name:
+                            break
+                    groups.append(sorted(group))
+    return groups
+
 
 class SchemasStore:
+    """Stores schemas by name.
+    In lazy mode, load_folder only indexes the files and schemas are parsed
+    the first time they are used. With a cache_path, parsed schemas are
+    cached on disk by file path, modification time and size, so loading
+    unchanged files again doesn't need to parse them. The cache is saved
+    by load_folder in eager mode, call save_cache in lazy mode.
+    reload (or watch in the background) picks up changes to the loaded
+    folders and notifies the listeners of the schemas that changed.
+    resolved returns schemas with the named types they use expanded,
+    shared by the generators, validators and models.
+    The store can be used from several threads while it's watched, the
+    reads and the reloads hold lock. Pickled copies (as sent to worker
+    processes) don't keep the listeners and aren't watched."""
 
-    def __init__(self):
+    def __init__(self, lazy=False, cache_path=None):
+        # name -> (json string or None until needed, dict)
         self.schemas = {}
+        # name -> path of the files indexed but not loaded yet
+        self.paths = {}
+        self.lazy = lazy
+        self.cache_path = cache_path
+        # path -> ((mtime, size), name, marshalled schema)
+        self.cache = self.load_cache() if cache_path else {}
+        # path -> (file key, schema name or None if not parsed yet)
+        self.files = {}
+        self.folders = []
+        self.listeners = []
+        self.lock = threading.RLock()
+        self.watch_stop = None
+        self.clear_resolved()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        # locks, weak references and the watching thread can't be pickled
+        for name in ["lock", "listeners", "watch_stop"]:
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.listeners = []
+        self.lock = threading.RLock()
+        self.watch_stop = None
 
     def add_schema(self, schema):
+        with self.lock:
+            self.clear_resolved()
+            return self.store_schema(schema)
+
+    def store_schema(self, schema):
         try:
             if isinstance(schema, dict):
-                j_schema = json.dumps(schema)
-                self.schemas[schema["name"]] = (j_schema, schema)
+                self.schemas[schema["name"]] = (None, schema)
             elif isinstance(schema, str):
                 d_schema = json.loads(schema)
                 self.schemas[d_schema["name"]] = (schema, d_schema)
@@ -19,20 +151,348 @@ class SchemasStore:
             return False
 
     def schema(self, name, as_dict=False):
-        if name not in self.schemas:
-            return None
+        with self.lock:
+            if name not in self.schemas and not self.load_indexed(name):
+                return None
 
-        if not as_dict:
-            return self.schemas[name][0]
-        return self.schemas[name][1]
+            j_schema, d_schema = self.schemas[name]
+            if as_dict:
+                return d_schema
+            if j_schema is None:
+                # only serialize when the string is needed
+                j_schema = json.dumps(d_schema)
+                self.schemas[name] = (j_schema, d_schema)
+            return j_schema
 
     def load_folder(self, folder):
         """Loads schemas from a folder"""
-        for name in os.listdir(folder):
-            path = os.path.join(folder,name)
-            if os.path.isfile(path):
-                schema = open(path).read().replace("\t"," "*8)
-                self.add_schema(schema)
-
-                
-                
+        with self.lock:
+            if folder not in self.folders:
+                self.folders.append(folder)
+
+            for name in os.listdir(folder):
+                path = os.path.join(folder,name)
+                if os.path.isfile(path):
+                    self.add_file(path)
+
+            if self.cache_path and not self.lazy:
+                self.save_cache()
+
+    def add_file(self, path):
+        """Loads or indexes a file depending on the mode"""
+        self.clear_resolved()
+        key = self.file_key(path)
+        cached = self.cache.get(path)
+        if cached and cached[0] == key:
+            if self.lazy:
+                self.paths[cached[1]] = path
+                self.files[path] = (key, None)
+            else:
+                self.schemas[cached[1]] = (None, marshal.loads(cached[2]))
+                self.files[path] = (key, cached[1])
+        elif self.lazy:
+            # assume the schema has the name of the file until it's parsed
+            self.paths[os.path.splitext(os.path.basename(path))[0]] = path
+            self.files[path] = (key, None)
+        else:
+            self.load_file(path)
+
+    def load_file(self, path):
+        """Parses a schema file and adds it to the cache.
+        The resolved schemas are kept, add_file clears them: parsing an
+        indexed file doesn't change the schemas used so far."""
+        try:
+            schema = json.loads(open(path).read().replace("\t"," "*8))
+            name = schema["name"]
+        except (ValueError, KeyError, TypeError):
+            return None
+
+        self.store_schema(schema)
+        key = self.file_key(path)
+        self.files[path] = (key, name)
+        if self.cache_path:
+            self.cache[path] = (key, name, marshal.dumps(schema))
+        return name
+
+    def load_indexed(self, name):
+        """Loads an indexed schema, returns False if it can't be found"""
+        path = self.paths.pop(name, None)
+        if path:
+            cached = self.cache.get(path)
+            if cached and cached[0] == self.file_key(path) and cached[1] == name:
+                self.schemas[name] = (None, marshal.loads(cached[2]))
+                self.files[path] = (cached[0], name)
+            else:
+                self.load_file(path)
+            if name in self.schemas:
+                return True
+
+        # the name may not match the file name, parse the remaining files
+        while name not in self.schemas and self.paths:
+            self.load_file(self.paths.popitem()[1])
+        return name in self.schemas
+
+    def names(self):
+        """Returns the names of all the schemas, loading the indexed ones"""
+        with self.lock:
+            while self.paths:
+                self.load_indexed(next(iter(self.paths)))
+            return list(self.schemas.keys())
+
+    def clear_resolved(self):
+        self.resolved_cache = {}
+        # name -> names of the schemas it uses, only for the schemas used so far
+        self.graph = {}
+        # names of the graph in topological order and their position in it
+        self.order = []
+        self.order_index = {}
+        self.recursive = set()
+
+    def dependency_graph(self, names=None):
+        """Returns a dict name -> names of the schemas it uses, with at least
+        names and the schemas they use, directly or not (all the schemas if
+        names is None). In lazy mode, only the files of these schemas are parsed."""
+        with self.lock:
+            if names is None:
+                names = self.names()
+            self.add_to_graph(names)
+            return self.graph
+
+    def add_to_graph(self, names):
+        """Adds names and the schemas they use to the graph, then orders the
+        new schemas. The schemas already in the graph can't use the new ones,
+        so their order and recursion don't change."""
+        new = []
+        pending = [name for name in names if name not in self.graph]
+        while pending:
+            name = pending.pop()
+            if name in self.graph:
+                continue
+            schema = self.schema(name, True)
+            if schema is None:
+                continue
+            self.graph[name] = set(ref for ref in referenced_types(schema)
+                                   if self.schema(ref, True) is not None)
+            new.append(name)
+            pending.extend(ref for ref in self.graph[name] if ref not in self.graph)
+
+        # the schemas already in the graph are ordered, only order the new ones
+        for group in strongly_connected(self.graph, sorted(new)):
+            if len(group) > 1 or group[0] in self.graph[group[0]]:
+                self.recursive.update(group)
+            for name in group:
+                self.order_index[name] = len(self.order)
+                self.order.append(name)
+
+    def strongly_connected(self):
+        """Returns the groups of schemas depending on each other (cycles),
+        a schema used by another schema is always in an earlier group"""
+        with self.lock:
+            graph = self.dependency_graph()
+            return strongly_connected(graph, sorted(graph))
+
+    def topological_order(self, names=None):
+        """Returns the names of the schemas, each after the ones it uses
+        (schemas in a cycle are next to each other), only names and the
+        schemas they use if names is given"""
+        with self.lock:
+            graph = self.dependency_graph(names)
+            if names is None:
+                return list(self.order)
+            used = set()
+            pending = [name for name in names if name in graph]
+            while pending:
+                name = pending.pop()
+                if name not in used:
+                    used.add(name)
+                    pending.extend(graph[name])
+            return sorted(used, key=self.order_index.__getitem__)
+
+    def recursive_types(self, names=None):
+        """Returns the names of the schemas using themselves, directly or not,
+        among names and the schemas they use if names is given"""
+        with self.lock:
+            self.dependency_graph(names)
+            return set(self.recursive)
+
+    def resolved(self, name):
+        """Returns the schema with the named types it uses expanded.
+        References to recursive types are kept as names, so they can be
+        resolved when used. The result is memoized and shared, don't
+        modify it."""
+        with self.lock:
+            if name not in self.resolved_cache:
+                # resolve the schemas used first, so the references are
+                # memoized when expanded and deep chains don't recurse
+                for used in self.topological_order([name]):
+                    if used not in self.resolved_cache:
+                        self.resolved_cache[used] = self.expand(self.schema(used, True), self.recursive)
+            return self.resolved_cache.get(name)
+
+    def expand(self, schema, recursive):
+        if not isinstance(schema, dict):
+            return schema
+
+        ref = type_reference(schema)
+        if ref and ref not in recursive and ref in self.resolved_cache:
+            # constraints of the reference apply on top of the type
+            expanded = dict(self.resolved_cache[ref])
+            expanded.update((key, value) for key, value in list(schema.items())
+                            if key not in ["type", "name"])
+            return expanded
+
+        expanded = dict(schema)
+        if isinstance(schema.get("properties"), dict):
+            expanded["properties"] = dict((prop_name, self.expand(prop_schema, recursive))
+                                          for prop_name, prop_schema in list(schema["properties"].items()))
+        if isinstance(schema.get("items"), dict):
+            expanded["items"] = self.expand(schema["items"], recursive)
+        return expanded
+
+    def add_listener(self, listener):
+        """Registers listener(names) to be called with the names of the
+        schemas changed by reload and the schemas using them.
+        Only a weak reference is kept to bound methods."""
+        with self.lock:
+            # drop the listeners of the objects collected since
+            self.listeners = [ref for ref in self.listeners if ref() is not None]
+            if hasattr(listener, "__self__"):
+                self.listeners.append(weakref.WeakMethod(listener))
+            else:
+                self.listeners.append(lambda: listener)
+
+    def dependents(self, names):
+        """Returns names and the names of the loaded schemas using them,
+        directly or not"""
+        with self.lock:
+            references = dict((name, referenced_types(d_schema))
+                              for name, (j_schema, d_schema) in list(self.schemas.items()))
+            res = set(names)
+            while True:
+                new = set(name for name, refs in list(references.items())
+                          if name not in res and refs & res)
+                if not new:
+                    return res
+                res |= new
+
+    def reload(self):
+        """Reloads the files of the loaded folders that changed since they
+        were loaded, removes the deleted ones and notifies the listeners.
+        Returns the names of the changed schemas.
+        Only the store lookups and the listeners see the changes: compiled
+        generators, Validators and the validators of the models generated
+        by name are updated, the properties, keys and links of generated
+        models aren't."""
+        with self.lock:
+            changed = set()
+            seen = set()
+            for folder in self.folders:
+                for file_name in os.listdir(folder):
+                    path = os.path.join(folder, file_name)
+                    if not os.path.isfile(path):
+                        continue
+                    seen.add(path)
+
+                    old = self.files.get(path)
+                    if old and old[0] == self.file_key(path):
+                        continue
+                    if old and old[1]:
+                        self.schemas.pop(old[1], None)
+                        changed.add(old[1])
+                    if old and not old[1]:
+                        # not parsed yet, nothing uses it
+                        self.files[path] = (self.file_key(path), None)
+                        continue
+
+                    self.add_file(path)
+                    name = self.files.get(path, (None, None))[1]
+                    if name:
+                        changed.add(name)
+
+            for path, (key, name) in list(self.files.items()):
+                if path not in seen:
+                    del self.files[path]
+                    if name:
+                        self.schemas.pop(name, None)
+                        changed.add(name)
+                    else:
+                        for indexed_name, indexed_path in list(self.paths.items()):
+                            if indexed_path == path:
+                                del self.paths[indexed_name]
+            if changed:
+                self.clear_resolved()
+
+        # outside of the lock, the listeners may use the store
+        if changed:
+            self.notify(changed)
+        return changed
+
+    def notify(self, names):
+        names = self.dependents(names)
+        for ref in list(self.listeners):
+            listener = ref()
+            if listener is not None:
+                listener(names)
+        with self.lock:
+            self.listeners = [ref for ref in self.listeners if ref() is not None]
+
+    def watch(self, interval=1.0):
+        """Starts reloading the loaded folders in the background when they
+        change, using inotify if inotify_simple is installed or checking
+        the files every interval seconds otherwise"""
+        if self.watch_stop:
+            return
+        self.watch_stop = threading.Event()
+        thread = threading.Thread(target=self.watch_loop, args=(self.watch_stop, interval))
+        thread.daemon = True
+        thread.start()
+
+    def stop_watching(self):
+        if self.watch_stop:
+            self.watch_stop.set()
+            self.watch_stop = None
+
+    def watch_loop(self, stop, interval):
+        inotify = None
+        if INotify is not None:
+            inotify = INotify()
+            watch_flags = flags.CREATE | flags.DELETE | flags.MODIFY | \
+                flags.CLOSE_WRITE | flags.MOVED_TO | flags.MOVED_FROM
+            for folder in self.folders:
+                inotify.add_watch(folder, watch_flags)
+
+        while not stop.is_set():
+            if inotify is not None:
+                if not inotify.read(timeout=int(interval * 1000)):
+                    continue
+            elif stop.wait(interval):
+                break
+            try:
+                self.reload()
+            except Exception:
+                traceback.print_exc()
+
+        if inotify is not None:
+            inotify.close()
+
+    def file_key(self, path):
+        stat = os.stat(path)
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def load_cache(self):
+        try:
+            with open(self.cache_path, "rb") as cache_file:
+                version, cache = marshal.load(cache_file)
+            # marshal format depends on the python version
+            if version == sys.version_info[:2]:
+                return cache
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            pass
+        return {}
+
+    def save_cache(self):
+        """Writes the parsed schemas to the cache file"""
+        tmp_path = self.cache_path + ".tmp"
+        with open(tmp_path, "wb") as cache_file:
+            marshal.dump((tuple(sys.version_info[:2]), self.cache), cache_file)
+        os.replace(tmp_path, self.cache_path)
@@ -1,64 +1,101 @@
-import re
 import itertools
+import os
+import random
+from urllib.parse import quote
 
 from .datagenerator import DataGenerator
+from .invaliddatagenerator import InvalidDataGenerator
 from .schemasstore import SchemasStore
+from . import utils
 
 class UrlGenerator:
 
-      args_regex = re.compile("\{([A-Z0-9\-_a-z]+)\}")
+      args_regex = utils.url_args_regex
 
-      def __init__(self):
-            self.data_generator = DataGenerator()
+      def __init__(self, schemas_store=None, seed=None):
+            self.data_generator = DataGenerator(schemas_store, seed=seed)
+            self.invalid_data_generator = InvalidDataGenerator(schemas_store, seed=seed)
+            self.random = random.Random(seed)
+            # href -> (template, argument names)
+            self.templates = {}
 
-      def generate_valid(self, schema):
-            """Generate valid urls defined in the "links" section
-               of the schema"""
-            urls = {}
-            for link in schema.get("links",[]):
-                  urls[link["rel"]] = []
-                  href = link["href"]
+      def compile_href(self, href):
+            """Returns the template of an href and the names of its arguments,
+               stuff/{foo}/{bar} gives (stuff/%s/%s, [foo, bar])"""
+            if href not in self.templates:
+                  names = self.args_regex.findall(href)
+                  template = self.args_regex.sub("%s", href.replace("%", "%%"))
+                  self.templates[href] = (template, names)
+            return self.templates[href]
 
-                  # for each argument, generate a list of valid values
-                  # and store it in args
-                  pos = 0
-                  args = []
-                  while True:
-                        m = self.args_regex.search(href,pos) 
-                        if not m:
-                              break
-                        # get the argument schema
-                        arg_name = m.group(1)
-                        arg_schema = schema["properties"][arg_name]
-                        
-                        # generate a list of valid values for the argument
-                        args.append([self.data_generator.random_value(arg_schema)])
-                        pos = m.end()+1
+      def candidates(self, schema, count=1, invalid=0):
+            """Returns count valid values for the schema of an argument,
+               followed by at most invalid invalid values"""
+            generate = self.data_generator.compile(schema)
+            values = [generate() for x in range(count)]
+            if invalid:
+                  values += self.invalid_data_generator.invalid_value(schema)[:invalid]
+            return values
+
+      def iter_urls(self, schema, rel=None, count=1, invalid=0, values=None, sample=None):
+            """Yields (rel, url) for the links of the schema (only rel if given),
+               one url per combination of the candidate values of the arguments.
+               The candidates of an argument are count valid values and invalid
+               invalid ones, or values[argument name] if given.
+               With sample, only that many combinations are drawn at random
+               from all the combinations, without enumerating them."""
+            for link in schema.get("links", []):
+                  if rel is not None and link["rel"] != rel:
+                        continue
+                  template, names = self.compile_href(link.get("href", ""))
 
-                  # replace stuff/{foo}/{bar} by stuff/%s/%s
-                  href = re.sub(r"\{[a-zA-Z_]+\}",r"%s", href)
+                  args = []
+                  for arg_name in names:
+                        if values and arg_name in values:
+                              args.append(list(values[arg_name]))
+                        else:
+                              args.append(self.candidates(schema["properties"][arg_name], count, invalid))
 
-                  # generate a combinations of all the values and generate a url
-                  # for each
-                  combinations = itertools.product(*args)
+                  if sample is None:
+                        combinations = itertools.product(*args)
+                  else:
+                        combinations = self.sample_product(args, sample)
                   for combination in combinations:
-                        url = href%combination
-                        urls[link["rel"]].append(url)
+                        yield link["rel"], template % tuple(quote(str(value), safe="")
+                                                            for value in combination)
+
+      def sample_product(self, args, count):
+            """Yields count distinct random combinations of the lists in args
+               (all of them if there are fewer), drawing indexes in the product
+               instead of building it"""
+            total = 1
+            for arg in args:
+                  total *= len(arg)
+            for index in self.random.sample(range(total), min(count, total)):
+                  combination = []
+                  for arg in reversed(args):
+                        index, arg_index = divmod(index, len(arg))
+                        combination.append(arg[arg_index])
+                  yield tuple(reversed(combination))
+
+      def generate_valid(self, schema):
+            """Generate valid urls defined in the "links" section
+               of the schema"""
+            urls = dict((link["rel"], []) for link in schema.get("links", []))
+            for rel, url in self.iter_urls(schema):
+                  urls[rel].append(url)
             return urls
 
 if __name__ == "__main__":
 
       # load schemas
       store = SchemasStore()
-      store.load_folder("data/schemas")
-      
+      store.load_folder(os.path.join(os.path.dirname(__file__), "data/schemas"))
+
       # generate urls for the links in book
-      generator = UrlGenerator()
+      generator = UrlGenerator(store)
       print(generator.generate_valid(store.schema("book",True)))
 
-                        
-                        
-                  
-                  
-                  
-                        
+      # 5 valid and 5 invalid isbns, 3 of them at random
+      for rel, url in generator.iter_urls(store.schema("book",True), rel="self", count=5, invalid=5, sample=3):
+            print(rel, url)
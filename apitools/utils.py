@@ -1,4 +1,8 @@
+import collections
+import hashlib
 import re
+import threading
+from urllib.parse import urlencode
 
 
 url_args_regex = re.compile("\{([A-Z0-9\-_a-z]+)\}")
@@ -51,3 +55,126 @@ def url_to_flask_route(url, model):
 
 def url_to_template(url):
     return re.sub(r"\{([a-zA-Z_]+)\}",r"%(\1)s", url)
+
+def url_to_regex(url, model):
+    """Returns a compiled regex matching the link url, with a named group
+    per argument (same values as the flask converters)"""
+    parts = url_args_regex.split(url)
+    regex = ""
+    for index, part in enumerate(parts):
+        if index % 2 == 0:
+            regex += re.escape(part)
+        else:
+            regex += "(?P<%s>%s)" % (part, {"integer":r"\d+",
+                                            "number":r"\d+\.\d+",
+                                            "string":"[^/]+"
+                                            }[model.properties[part]["type"]])
+    return re.compile(regex + "$")
+
+# converts query string values to the type of a property
+property_types = {
+    "integer":int,
+    "number":float,
+    "boolean":lambda value: value.lower() in ["1", "true"],
+    "string":str,
+}
+
+# query string arguments of the instances routes that are not filters
+reserved_args = ["limit", "offset", "after", "stream", "fields"]
+
+def filter_clauses(model, args):
+    """Translates <property>=, <property>__min=, <property>__max= and
+    <property>__prefix= query string arguments into SQL clauses.
+    Raises ValueError for unknown properties and invalid values."""
+    clauses = []
+    for arg_name, value in list(args.items()):
+        if arg_name in reserved_args:
+            continue
+        prop_name, _, operator = arg_name.partition("__")
+        if prop_name not in model.properties:
+            raise ValueError("unknown property %s" % prop_name)
+        prop_type = model.properties[prop_name]["type"]
+        column = getattr(model, prop_name)
+
+        if operator == "prefix" and prop_type == "string":
+            escaped = value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            clauses.append(column.like(escaped + "%", escape="\\"))
+            continue
+
+        value = property_types.get(prop_type, str)(value)
+        if not operator:
+            clauses.append(column == value)
+        elif operator == "min" and prop_type in ["integer", "number"]:
+            clauses.append(column >= value)
+        elif operator == "max" and prop_type in ["integer", "number"]:
+            clauses.append(column <= value)
+        else:
+            raise ValueError("unsupported filter %s" % arg_name)
+    return clauses
+
+def next_page_query(args, limit, after):
+    """Returns the query string of the next page, keeping the filters and fields"""
+    args = [(arg_name, value) for arg_name, value in list(args.items())
+            if arg_name not in ["limit", "offset", "after"]]
+    return urlencode([("limit", limit), ("after", after)] + args)
+
+def make_etag(body):
+    return hashlib.sha1(body.encode("utf-8")).hexdigest()
+
+class ResponseCache:
+    """Thread safe LRU of serialized instances, (resource name, key) -> (body, etag).
+    A size of 0 disables it. Invalidations are numbered, so a body read
+    before a change isn't cached after it. Only the last size invalidations
+    are remembered, a read older than the forgotten ones isn't cached."""
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        # (resource name, key) -> generation of its last invalidation
+        self.invalidated = collections.OrderedDict()
+        self.last_generation = 0
+        self.forgotten_generation = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, name, key):
+        """Returns the cached (body, etag), None if not cached"""
+        with self.lock:
+            entry = self.entries.get((name, key))
+            if entry is not None:
+                self.entries.move_to_end((name, key))
+            return entry
+
+    def generation(self):
+        """Returns the current generation, to read before querying the database"""
+        with self.lock:
+            return self.last_generation
+
+    def put(self, name, key, body, generation=None):
+        """Caches the body, returns (body, etag). If the generation read
+        before the query is given and the key may have been invalidated
+        since, the body may be stale and isn't cached"""
+        entry = (body, make_etag(body))
+        if self.size:
+            with self.lock:
+                if generation is not None and (generation < self.forgotten_generation or
+                                               generation < self.invalidated.get((name, key), 0)):
+                    return entry
+                self.entries[(name, key)] = entry
+                self.entries.move_to_end((name, key))
+                while len(self.entries) > self.size:
+                    self.entries.popitem(last=False)
+        return entry
+
+    def invalidate(self, name, key):
+        with self.lock:
+            self.entries.pop((name, key), None)
+            if not self.size:
+                return
+            self.last_generation += 1
+            self.invalidated[(name, key)] = self.last_generation
+            self.invalidated.move_to_end((name, key))
+            while len(self.invalidated) > self.size:
+                self.forgotten_generation = self.invalidated.popitem(last=False)[1]
@@ -1,5 +1,11 @@
+import json
 import re
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 class ValidationError(Exception):
     def __init__(self, type_name, value, message):
@@ -25,19 +31,21 @@ def integer_tests(schema):
 
 def numeric_tests(schema):
     message = "%(test_type)s is %(test_value)s"
+    minimum = schema.get("minimum")
+    maximum = schema.get("maximum")
 
     tests = {
           "minimum": (lambda value, min_value: value >= min_value, message),
           "maximum": (lambda value, max_value: value <= max_value, message),
-          "exclusiveMinimum": (lambda value, is_exclusive: not is_exclusive or value != schema["minimum"], message),
-          "exclusiveMaximum": (lambda value, is_exclusive: not is_exclusive or value != schema["maximum"], message),
+          "exclusiveMinimum": (lambda value, is_exclusive: not is_exclusive or value != minimum, message),
+          "exclusiveMaximum": (lambda value, is_exclusive: not is_exclusive or value != maximum, message),
           }
     return tests
 
 
 def string_tests(schema):
     tests = {
-          "__isString": (lambda value: isinstance(value, basestring), "'%(value)s' is not a string"),
+          "__isString": (lambda value: isinstance(value, str), "'%(value)s' is not a string"),
           "minLength": (lambda value, min_len: len(value) >= min_len, "length must be >= %(test_value)s"),
           "maxLength": (lambda value, max_len: len(value) <= max_len, "length must be <= %(test_value)s"),
           "pattern": (lambda value, pattern: re.match(pattern, value), "must match %(test_value)r"),
@@ -45,27 +53,41 @@ def string_tests(schema):
     return tests
 
 
+def bind_test(test_fn, test_value):
+    """Returns a one argument version of a test taking the schema value"""
+    return lambda value: test_fn(value, test_value)
+
+
+def compile_tests(schema, tests):
+    """Returns the tests relevant to the schema as a sorted tuple of
+    (test_fn, test_name, test_value, message), with test_fn only taking
+    the value to check"""
+    compiled = []
+    for test_name, (test_fn, message) in sorted(tests.items()):
+        if test_name.startswith("__"):
+            compiled.append((test_fn, test_name, None, message))
+        elif test_name in schema:
+            test_value = schema[test_name]
+            bound_value = test_value
+            if test_name == "pattern":
+                bound_value = re.compile(test_value)
+            compiled.append((bind_test(test_fn, bound_value), test_name, test_value, message))
+    return tuple(compiled)
+
+
 def generate_validator_from_tests(prop_name, schema, tests):
     """Combine test functions into a single validator"""
-    # only keep the relevant tests
-    found_tests = [(name, test) for (name, test) in list(tests.items())
-                   if name in schema or name.startswith("__")]
+    # only keep the relevant tests, sorted and bound to their schema value
+    compiled_tests = compile_tests(schema, tests)
 
     # if no tests are found, no validator is required
-    if len(found_tests) == 0:
+    if len(compiled_tests) == 0:
         return None
 
     def fn(self, key, value):
-        for test_name, (test_fn, message) in sorted(found_tests,
-                                                    key=lambda test: test[0]):
-            res = False
-            test_value = schema.get(test_name, None)
-            if not test_name.startswith("__"):
-                res = test_fn(value, test_value)
-            else:
-                res = test_fn(value)
-
-            if not res:
+        for test_fn, test_name, test_value, message in compiled_tests:
+            if not test_fn(value):
+                # only format the message on failure
                 raise ValidationError(
                     prop_name, value, message % {"test_type": test_name,
                                                  "test_value": test_value,
@@ -75,7 +97,9 @@ def generate_validator_from_tests(prop_name, schema, tests):
     return fn
 
 
-def generate_validator_for_property(prop_name, schema):
+def property_tests(schema):
+    """Returns the tests for a property of a basic type, None if the
+    type doesn't have tests"""
     attr_name = "%s_tests" % schema["type"]
     method = globals().get(attr_name, None)
 
@@ -86,6 +110,282 @@ def generate_validator_for_property(prop_name, schema):
     if "enum" in schema:
         tests["enum"] = (
             lambda value, values: value in values,
-            " % (value)s is not in the enum list")
+            "%(value)s is not in the enum list")
+    return tests
+
+
+def generate_validator_for_property(prop_name, schema):
+    tests = property_tests(schema)
+    if tests is None:
+        return None
 
     return generate_validator_from_tests(prop_name, schema, tests)
+
+
+class DocumentValidationError(Exception):
+    def __init__(self, errors):
+        Exception.__init__(self, "; ".join("%s: %s" % (path or "/", message)
+                                           for path, message in errors))
+        self.errors = errors
+
+
+class StopValidation(Exception):
+    pass
+
+
+def json_pointer(path):
+    """Converts a path built as nested (parent, key) tuples to a json pointer"""
+    parts = []
+    while path:
+        path, key = path
+        parts.append(str(key).replace("~", "~0").replace("/", "~1"))
+    return "".join("/" + part for part in reversed(parts))
+
+
+class Validator:
+    """Validates whole documents against a schema.
+    The schema is compiled once into a tree of checks. In fail_fast mode
+    validation stops at the first error, otherwise all the errors are
+    collected with the json pointer of the invalid value.
+    The checks are recompiled when the schemas they use are reloaded by
+    the store, unless listen is False (for short lived validators)."""
+
+    basic_types = ["string", "boolean", "number", "integer", "object", "array"]
+
+    def __init__(self, schema, schemas_store=None, fail_fast=False, listen=True):
+        self.schemas_store = schemas_store
+        self.fail_fast = fail_fast
+        self.schema = schema
+        self.recompile()
+        if schemas_store and listen:
+            schemas_store.add_listener(self.schemas_changed)
+
+    def recompile(self):
+        compiled = {}
+        if self.schemas_store:
+            # a reload can't change the schemas while they are compiled
+            with self.schemas_store.lock:
+                check = self.compile(self.schema, compiled)
+        else:
+            check = self.compile(self.schema, compiled)
+        self.check, self.used_types = check, set(compiled)
+
+    def schemas_changed(self, names):
+        """Recompiles the checks if they use one of the changed schemas"""
+        if self.used_types & names:
+            self.recompile()
+
+    def errors(self, instance):
+        """Returns the list of (json pointer, message) errors of the instance"""
+        errors = []
+        try:
+            self.check(instance, None, errors)
+        except StopValidation:
+            pass
+        return [(json_pointer(path), message) for path, message in errors]
+
+    def is_valid(self, instance):
+        return len(self.errors(instance)) == 0
+
+    def validate(self, instance):
+        """Raises a DocumentValidationError if the instance is invalid"""
+        errors = self.errors(instance)
+        if errors:
+            raise DocumentValidationError(errors)
+        return instance
+
+    def validate_stream(self, instances):
+        """Validates an iterable of instances, or of ndjson lines, and yields
+        (index, errors) for the invalid ones"""
+        for index, instance in enumerate(instances):
+            if isinstance(instance, (str, bytes)):
+                if not instance.strip():
+                    continue
+                try:
+                    instance = json.loads(instance)
+                except ValueError as error:
+                    yield index, [("", "invalid json: %s" % error)]
+                    continue
+            errors = self.errors(instance)
+            if errors:
+                yield index, errors
+
+    def error(self, errors, path, message):
+        errors.append((path, message))
+        if self.fail_fast:
+            raise StopValidation()
+
+    def compile(self, schema, compiled):
+        if isinstance(schema, str):
+            schema = {"type": schema}
+
+        type_name = schema.get("type", "any")
+        if type_name == "any":
+            return lambda value, path, errors: None
+
+        if type_name not in self.basic_types:
+            return self.compile_named(type_name, compiled)
+
+        if type_name == "object":
+            return self.compile_object(schema, compiled)
+        if type_name == "array":
+            return self.compile_array(schema, compiled)
+        if type_name == "boolean":
+            return self.compile_boolean(schema)
+        return self.compile_property(schema)
+
+    def compile_named(self, type_name, compiled):
+        if type_name in compiled:
+            # already compiled or being compiled (recursive type),
+            # resolve it when validating
+            return lambda value, path, errors: compiled[type_name](value, path, errors)
+
+        schema = self.schemas_store.resolved(type_name) if self.schemas_store else None
+        if not schema:
+            raise Exception("Unknown type '%s'" % type_name)
+        compiled[type_name] = None
+        check = compiled[type_name] = self.compile(schema, compiled)
+        return check
+
+    def compile_property(self, schema):
+        compiled_tests = compile_tests(schema, property_tests(schema))
+        error = self.error
+
+        def check(value, path, errors):
+            for test_fn, test_name, test_value, message in compiled_tests:
+                if not test_fn(value):
+                    error(errors, path, message % {"test_type": test_name,
+                                                   "test_value": test_value,
+                                                   "value": value})
+                    # the other tests may not apply to an invalid type
+                    if test_name.startswith("__"):
+                        return
+        return check
+
+    def compile_boolean(self, schema):
+        error = self.error
+
+        def check(value, path, errors):
+            if not isinstance(value, bool):
+                error(errors, path, "'%s' is not a boolean" % (value,))
+        return check
+
+    def compile_object(self, schema, compiled):
+        required = schema.get("required", [])
+        if not isinstance(required, list):
+            required = []
+
+        properties = []
+        for prop_name, prop_schema in list(schema.get("properties", {}).items()):
+            prop_required = prop_schema.get("required", False) or prop_name in required
+            properties.append((prop_name, self.compile(prop_schema, compiled), prop_required))
+        known = frozenset(schema.get("properties", {}))
+        additional = schema.get("additionalProperties", True) is not False
+        error = self.error
+
+        def check(value, path, errors):
+            if not isinstance(value, dict):
+                error(errors, path, "'%s' is not an object" % (value,))
+                return
+            for prop_name, prop_check, prop_required in properties:
+                if prop_name in value:
+                    prop_check(value[prop_name], (path, prop_name), errors)
+                elif prop_required:
+                    error(errors, (path, prop_name), "%s is required" % prop_name)
+            if not additional:
+                for prop_name in value:
+                    if prop_name not in known:
+                        error(errors, (path, prop_name), "unknown property %s" % prop_name)
+        return check
+
+    def compile_array(self, schema, compiled):
+        items = schema.get("items", {})
+        if items.get("type") == "object" and "name" in items:
+            items = items["name"]
+        item_check = self.compile(items, compiled)
+        min_items = schema.get("minItems")
+        max_items = schema.get("maxItems")
+        unique_items = schema.get("uniqueItems", False)
+        error = self.error
+
+        def check(value, path, errors):
+            if not isinstance(value, list):
+                error(errors, path, "'%s' is not an array" % (value,))
+                return
+            if min_items is not None and len(value) < min_items:
+                error(errors, path, "must have at least %s items" % min_items)
+            if max_items is not None and len(value) > max_items:
+                error(errors, path, "must have at most %s items" % max_items)
+            if unique_items:
+                keys = set()
+                for index, item in enumerate(value):
+                    key = json.dumps(item, sort_keys=True)
+                    if key in keys:
+                        error(errors, (path, index), "duplicate item")
+                    keys.add(key)
+            for index, item in enumerate(value):
+                item_check(item, (path, index), errors)
+        return check
+
+
+# tests that work on whole numpy arrays of numbers
+vectorized_tests = ["minimum", "maximum", "exclusiveMinimum", "exclusiveMaximum", "divisibleBy"]
+
+
+def validate_batch(schema, rows, schemas_store=None, details=False):
+    """Validates a list of objects sharing the same schema, one property
+    at a time over all the rows. Numeric constraints are checked with numpy
+    when available. Returns a list of booleans, True for the invalid rows.
+    With details=True, also returns a dict (property name, test name) ->
+    indexes of the rows failing the test."""
+    if isinstance(schema, str):
+        schema = schemas_store.resolved(schema) if schemas_store else None
+        if not schema:
+            raise Exception("Unknown schema")
+
+    required = schema.get("required", [])
+    if not isinstance(required, list):
+        required = []
+
+    missing = object()
+    invalid = [False] * len(rows)
+    failures = {}
+
+    def fail(prop_name, test_name, indexes):
+        if indexes:
+            failures.setdefault((prop_name, test_name), []).extend(indexes)
+            for index in indexes:
+                invalid[index] = True
+
+    for prop_name, prop_schema in list(schema.get("properties", {}).items()):
+        column = [row.get(prop_name, missing) for row in rows]
+        indexes = [index for index, value in enumerate(column) if value is not missing]
+        values = [column[index] for index in indexes]
+
+        if prop_schema.get("required", False) or prop_name in required:
+            fail(prop_name, "required", [index for index, value in enumerate(column)
+                                         if value is missing])
+
+        tests = property_tests(prop_schema) if prop_schema["type"] in ["string", "number", "integer"] else None
+        if tests is None:
+            # objects, arrays, booleans and named types
+            validator = Validator(prop_schema, schemas_store, fail_fast=True, listen=False)
+            fail(prop_name, "type", [index for index, value in zip(indexes, values)
+                                     if not validator.is_valid(value)])
+            continue
+
+        for test_fn, test_name, test_value, message in compile_tests(prop_schema, tests):
+            if numpy is not None and test_name in vectorized_tests and values:
+                passed = numpy.broadcast_to(test_fn(numpy.asarray(values)), len(values)).tolist()
+            else:
+                passed = [bool(test_fn(value)) for value in values]
+            fail(prop_name, test_name, [index for index, ok in zip(indexes, passed) if not ok])
+
+            if test_name.startswith("__"):
+                # only keep values of the right type for the other tests
+                indexes = [index for index, ok in zip(indexes, passed) if ok]
+                values = [value for value, ok in zip(values, passed) if ok]
+
+    if details:
+        return invalid, failures
+    return invalid